@@ -1,7 +1,8 @@
 from django.contrib import admin
 from core.models import (OtherConstraints, Pair, Student,
                          GroupConstraints, TheoryGroup,
-                         LabGroup, Teacher)
+                         LabGroup, Teacher, GroupPreference,
+                         WaitlistEntry)
 
 # Update the registration to include this customised interface
 admin.site.register(Teacher)
@@ -11,3 +12,5 @@ admin.site.register(Student)
 admin.site.register(GroupConstraints)
 admin.site.register(TheoryGroup)
 admin.site.register(LabGroup)
+admin.site.register(GroupPreference)
+admin.site.register(WaitlistEntry)
@@ -0,0 +1,157 @@
+"""Admission layer (waiting room) for the group selection opening moment.
+
+Only ``ADMISSION_SLOTS`` seat requests are processed at the same time. The
+slots are lock files under ``ADMISSION_DIR``, locked with ``flock``, which
+means they are shared by every gunicorn worker on the same host and they
+are automatically freed by the OS if a worker dies while holding one.
+
+Everyone else gets a lightweight queue page (rendered without any query but
+the ones that authenticated the student, who must be logged in before
+taking a slot or a ticket) telling them their approximate position and when
+to retry.
+"""
+import os
+import tempfile
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.shortcuts import render
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover (Windows has no flock)
+    fcntl = None
+
+# Cookie where the queue ticket of a waiting student is kept, so the
+# waiting room doesn't need to write the session to the database
+TICKET_COOKIE = 'admission_ticket'
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _directory():
+    directory = _setting('ADMISSION_DIR',
+                         os.path.join(tempfile.gettempdir(),
+                                      'labassign-admission'))
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def acquire_slot():
+    """Tries to take one of the free admission slots, without blocking.
+
+    :return: The open slot file (keep it until :meth:`release_slot`), or
+    `None` if every slot is taken
+    :rtype: file
+    """
+    slots = _setting('ADMISSION_SLOTS', 20)
+    directory = _directory()
+    # Start at a different slot on each process so that workers don't all
+    # fight for slot 0
+    start = os.getpid() % slots
+    for i in range(slots):
+        path = os.path.join(directory, 'slot-%d.lock' % ((start + i) % slots))
+        slot = open(path, 'a')
+        try:
+            fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return slot
+        except OSError:
+            slot.close()
+    return None
+
+
+def release_slot(slot):
+    """Frees a slot previously returned by :meth:`acquire_slot`"""
+    fcntl.flock(slot, fcntl.LOCK_UN)
+    slot.close()
+
+
+def _tickets(take=False, serve=False, wait=False):
+    """Reads and updates the shared ticket counters (``next`` ticket to be
+    given and tickets ``served`` so far), under an exclusive lock.
+
+    The waiting students resend their request every ``Retry-After``
+    seconds, so if none of them has done it for ``ADMISSION_IDLE_RESET``
+    seconds, the waiting room is empty: the tickets left were abandoned,
+    and both counters start again from 0.
+
+    :param take: If a new ticket is given
+    :param serve: If the holder of a ticket is served
+    :param wait: If the holder of a ticket is still waiting
+    :return: The (next, served) counters, before taking a ticket
+    :rtype: tuple
+    """
+    path = os.path.join(_directory(), 'tickets')
+    now = time.time()
+    with open(path, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        values = f.read().split()
+        nxt, served, seen = (int(v) for v in values) if len(values) == 3\
+            else (0, 0, 0)
+        idle = now - seen > _setting('ADMISSION_IDLE_RESET', 60)
+        if idle:
+            nxt = served = 0
+        if take or serve or wait or (idle and values):
+            f.seek(0)
+            f.truncate()
+            f.write('%d %d %d' % (nxt + take, min(served + serve, nxt),
+                                  now if take or wait else seen))
+            f.flush()
+        fcntl.flock(f, fcntl.LOCK_UN)
+    return nxt, served
+
+
+def admission_required(view):
+    """Decorator that puts `POST` requests to a view behind the admission
+    slots. `GET` requests go straight to the view.
+
+    If there's no free slot, the queue page is returned with a
+    ``429 Too Many Requests`` status and a ``Retry-After`` header (not a
+    5xx, which would make Django log the request and load its user).
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method != 'POST' or fcntl is None\
+                or not _setting('ADMISSION_ENABLED', True):
+            return view(request, *args, **kwargs)
+
+        slot = acquire_slot()
+        if slot is None:
+            return _queue_page(request)
+        try:
+            if TICKET_COOKIE in request.COOKIES:
+                _tickets(serve=True)
+            response = view(request, *args, **kwargs)
+        finally:
+            release_slot(slot)
+        response.delete_cookie(TICKET_COOKIE)
+        return response
+    return wrapper
+
+
+def _queue_page(request):
+    retry = _setting('ADMISSION_RETRY_AFTER', 5)
+    ticket = request.COOKIES.get(TICKET_COOKIE)
+    nxt, served = _tickets(wait=True)
+    # A ticket given before the counters started again isn't valid
+    if ticket is None or not ticket.isdigit() or\
+            not served <= int(ticket) < nxt:
+        ticket, served = _tickets(take=True)
+    else:
+        ticket = int(ticket)
+    context_dict = {
+        'position': max(1, ticket - served + 1),
+        'retry_after': retry,
+        'action': request.path,
+        # Re-send the same form when retrying
+        'data': [(k, v) for k, v in request.POST.items()
+                 if k != 'csrfmiddlewaretoken'],
+    }
+    response = render(request, 'core/queue.html', context_dict, status=429)
+    response['Retry-After'] = str(retry)
+    response.set_cookie(TICKET_COOKIE, str(ticket))
+    return response
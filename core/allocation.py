@@ -0,0 +1,156 @@
+"""Batch allocation of lab groups from ranked preferences.
+
+The assignment is solved as a min-cost flow problem:
+``source -> preference list -> lab group -> sink``, where the cost of an
+edge is the rank the students gave to that group, and the capacity of a
+group is its number of free seats.
+
+Students with the very same preference list are merged into a single node
+(with the number of students as its capacity), so the network only grows
+with the number of *distinct* lists, not with the number of students,
+which keeps thousands of students in the millisecond range.
+
+Validated pairs take two seats of the same group, which a flow can't
+express, so they are allocated first with "double seats" (half of the
+free seats of each group) and the single students get the seats left.
+"""
+from collections import OrderedDict, deque
+
+INFINITY = float('inf')
+
+
+def min_cost_flow(nodes, edges, source, sink):
+    """Successive shortest paths min-cost max-flow.
+
+    :param nodes: The number of nodes, numbered from 0
+    :type nodes: int
+    :param edges: The (from, to, capacity, cost) edges
+    :type edges: list
+    :param source: The source node
+    :type source: int
+    :param sink: The sink node
+    :type sink: int
+    :return: The flow that goes through each edge, in the same order
+    :rtype: list
+    """
+    graph = [[] for _ in range(nodes)]
+    # Residual graph, edge i is paired with its reverse edge i ^ 1
+    to, cap, cost = [], [], []
+    for u, v, c, w in edges:
+        graph[u].append(len(to))
+        to.append(v)
+        cap.append(c)
+        cost.append(w)
+        graph[v].append(len(to))
+        to.append(u)
+        cap.append(0)
+        cost.append(-w)
+
+    while True:
+        # Bellman-Ford (queue based), the residual graph has negative edges
+        dist = [INFINITY] * nodes
+        parent = [-1] * nodes
+        queued = [False] * nodes
+        dist[source] = 0
+        queue = deque([source])
+        while queue:
+            u = queue.popleft()
+            queued[u] = False
+            for e in graph[u]:
+                if cap[e] > 0 and dist[u] + cost[e] < dist[to[e]]:
+                    dist[to[e]] = dist[u] + cost[e]
+                    parent[to[e]] = e
+                    if not queued[to[e]]:
+                        queued[to[e]] = True
+                        queue.append(to[e])
+        if dist[sink] == INFINITY:
+            break
+
+        # Push as much as the path allows
+        push = INFINITY
+        v = sink
+        while v != source:
+            push = min(push, cap[parent[v]])
+            v = to[parent[v] ^ 1]
+        v = sink
+        while v != source:
+            cap[parent[v]] -= push
+            cap[parent[v] ^ 1] += push
+            v = to[parent[v] ^ 1]
+
+    # The flow of an edge is the capacity of its reverse edge
+    return [cap[2 * i + 1] for i in range(len(edges))]
+
+
+def _assign(units, seats):
+    """Assigns units of the same size, merging the equal preference lists.
+
+    :return: The {group: [unit]} assignment and the unassigned units
+    :rtype: tuple
+    """
+    kinds = OrderedDict()
+    for unit in units:
+        key = tuple(sorted(unit[1].items()))
+        kinds.setdefault(key, []).append(unit)
+    groups = list(seats)
+
+    # 0 is the source, 1 the sink, then the lists, then the groups
+    group_node = {g: 2 + len(kinds) + i for i, g in enumerate(groups)}
+    edges = []
+    for i, (key, members) in enumerate(kinds.items()):
+        edges.append((0, 2 + i, len(members), 0))
+    for i, key in enumerate(kinds):
+        for g, c in key:
+            if g in group_node:
+                edges.append((2 + i, group_node[g], len(kinds[key]), c))
+    for g in groups:
+        edges.append((group_node[g], 1, seats[g], 0))
+    flows = min_cost_flow(2 + len(kinds) + len(groups), edges, 0, 1)
+
+    assignment = {g: [] for g in groups}
+    # Students of the same list are served in the order they came
+    pending = {i: deque(members)
+               for i, members in enumerate(kinds.values())}
+    for (u, v, c, w), flow in zip(edges, flows):
+        if u >= 2 and v != 1:
+            for _ in range(flow):
+                assignment[groups[v - 2 - len(kinds)]]\
+                    .append(pending[u - 2].popleft())
+    unassigned = [unit for members in pending.values() for unit in members]
+    return assignment, unassigned
+
+
+def allocate(units, seats):
+    """Assigns lab groups to students and validated pairs.
+
+    :param units: The (students, {group: cost}) to assign, where students
+    is a tuple with one student, or with both members of a validated pair.
+    They should come in the order the preferences were sent, since that's
+    how ties are broken.
+    :type units: list
+    :param seats: The free seats of each group
+    :type seats: dict
+    :return: The {group: [students]} assignment and the units that
+    couldn't be assigned to any of their preferred groups
+    :rtype: tuple
+    """
+    seats = dict(seats)
+    assignment = {g: [] for g in seats}
+    unassigned = []
+
+    # Pairs first, each one takes a "double seat"
+    pairs = [u for u in units if len(u[0]) == 2]
+    assigned, left = _assign(pairs, {g: n // 2 for g, n in seats.items()})
+    for g, members in assigned.items():
+        for students, _ in members:
+            assignment[g].extend(students)
+        seats[g] -= 2 * len(members)
+    unassigned.extend(left)
+
+    singles = [u for u in units if len(u[0]) == 1]
+    assigned, left = _assign(singles, seats)
+    for g, members in assigned.items():
+        for students, _ in members:
+            assignment[g].extend(students)
+    unassigned.extend(left)
+    return assignment, unassigned
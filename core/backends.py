@@ -0,0 +1,32 @@
+"""Authentication backend that loads the logged in `Student` directly.
+
+Django's `ModelBackend` loads a `django.contrib.auth.models.User` on every
+request, and then every view needed one more query (the multi-table join)
+to get the `Student`, and the templates one more query for each of his
+groups. This backend gives the `Student` as ``request.user``, with his lab
+group (and its teacher) and his theory group, in a single query.
+"""
+from django.contrib.auth.backends import ModelBackend
+
+from core.models import Student
+
+
+class StudentBackend(ModelBackend):
+    """A `ModelBackend` whose users are students, if they are one"""
+
+    def get_user(self, user_id):
+        """Gets the logged in user, as a `Student` with his groups if he is
+        one (the superusers created by ``createsuperuser`` aren't)
+
+        :param user_id: The id of the user in the session
+        :type user_id: int
+        :return: The student, the user, or `None` if there is neither
+        :rtype: django.contrib.auth.models.User
+        """
+        try:
+            user = Student.objects\
+                .select_related('labGroup__teacher', 'theoryGroup')\
+                .get(pk=user_id)
+        except Student.DoesNotExist:
+            return super().get_user(user_id)
+        return user if self.user_can_authenticate(user) else None
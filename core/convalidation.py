@@ -0,0 +1,43 @@
+"""What-if counts of the convalidations for a grid of minimum grades.
+
+A student is convalidated with the minimum grades (theory, lab) if both
+his last year grades are strictly higher. Instead of filtering the
+students once for every pair of minimums, each student is placed once in
+a histogram cell (how many theory minimums and how many lab minimums his
+grades are higher than), and then a single 2D suffix sum over the cells
+gives the count of every pair of minimums at once. That's
+O(students * log(minimums) + minimums^2), whatever the size of the grid.
+"""
+from bisect import bisect_left
+
+
+def threshold_counts(grades, theory_minimums, lab_minimums):
+    """Counts the convalidated students for every pair of minimum grades.
+
+    :param grades: The (theory grade, lab grade) of every student
+    :type grades: iterable
+    :param theory_minimums: The minimum theory grades, sorted
+    :type theory_minimums: list
+    :param lab_minimums: The minimum lab grades, sorted
+    :type lab_minimums: list
+    :return: ``counts[i][j]``, the students with a theory grade higher
+    than ``theory_minimums[i]`` and a lab grade higher than
+    ``lab_minimums[j]``
+    :rtype: list
+    """
+    rows, cols = len(theory_minimums), len(lab_minimums)
+    # cells[a][b]: the students higher than exactly a theory minimums and
+    # b lab minimums (bisect_left counts the minimums strictly lower)
+    cells = [[0] * (cols + 1) for _ in range(rows + 1)]
+    for theory, lab in grades:
+        row = cells[bisect_left(theory_minimums, theory)]
+        row[bisect_left(lab_minimums, lab)] += 1
+
+    # A student higher than a minimums is counted for the first a of them,
+    # so the count of (i, j) is the sum of the cells after it
+    counts = [[0] * (cols + 1) for _ in range(rows + 1)]
+    for a in range(rows - 1, -1, -1):
+        row, below, cell = counts[a], counts[a + 1], cells[a + 1]
+        for b in range(cols - 1, -1, -1):
+            row[b] = cell[b + 1] + row[b + 1] + below[b] - below[b + 1]
+    return [row[:cols] for row in counts[:rows]]
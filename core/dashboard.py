@@ -0,0 +1,55 @@
+"""Versions of the home page of each student, for its cached fragment.
+
+The fragment with the summary of a student is cached (see home.html) with
+his groups and a version of his pairs in its key. The groups are already
+loaded with ``request.user``, so a change of group is seen right away, and
+every saved or deleted `Pair` bumps the version of both its students, now
+and again when the transaction commits.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+
+
+def _cache():
+    return caches[getattr(settings, 'SEAT_CACHE', 'default')]
+
+
+def _key(student_id):
+    return 'dashboard:%s:%d' % (connection.settings_dict['NAME'], student_id)
+
+
+def _start():
+    # Like the seat version, an evicted version starts again from a random
+    # number, so it can't repeat one of an older cached fragment
+    return uuid.uuid4().int >> 80
+
+
+def version(student_id):
+    """The version of the pairs of a student
+
+    :param student_id: The id of the student
+    :type student_id: int
+    :rtype: int
+    """
+    return _cache().get_or_set(_key(student_id), _start, None)
+
+
+def invalidate(*student_ids):
+    """Bumps the version of some students, now and on commit
+
+    :param student_ids: The ids of the students whose pairs changed
+    :type student_ids: int
+    """
+    keys = [_key(s) for s in student_ids if s is not None]
+
+    def bump():
+        for key in keys:
+            try:
+                _cache().incr(key)
+            except ValueError:
+                _cache().add(key, _start(), None)
+    bump()
+    transaction.on_commit(bump)
@@ -0,0 +1,90 @@
+"""In-memory index of the `GroupConstraints`: which lab groups each theory
+group can join, and which theory groups can join each lab group.
+
+The constraints barely change during a term, so each process builds the
+index once, lazily, with a single query. Saving or deleting a constraint
+(or a group) drops it, and also changes a version token in the shared
+cache, so the index of the other workers is rebuilt too. Each process
+checks that version at most once every `ELIGIBILITY_CHECK_TTL` seconds.
+"""
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+
+_index = {}
+
+
+def _version_key():
+    return 'eligibility:version:%s' % connection.settings_dict['NAME']
+
+
+def _get():
+    now = time.monotonic()
+    if _index.get('checked', 0) > now:
+        return _index
+    version = cache.get_or_set(_version_key(), uuid.uuid4().hex, None)
+    checked = now + getattr(settings, 'ELIGIBILITY_CHECK_TTL', 5)
+    if _index.get('version') != version:
+        from core.models import GroupConstraints
+
+        lab_groups, theory_groups = {}, {}
+        for tg, lg in GroupConstraints.objects\
+                .exclude(theoryGroup=None)\
+                .values_list('theoryGroup', 'labGroup'):
+            lab_groups.setdefault(tg, []).append(lg)
+            theory_groups.setdefault(lg, []).append(tg)
+        _index.clear()
+        _index.update(version=version, lab_groups=lab_groups,
+                      theory_groups=theory_groups)
+    _index['checked'] = checked
+    return _index
+
+
+def version():
+    """The version of the index, which changes with the constraints
+
+    :rtype: str
+    """
+    return _get()['version']
+
+
+def lab_groups(theory_group_id):
+    """The ids of the lab groups a theory group can join
+
+    :param theory_group_id: The id of the theory group
+    :type theory_group_id: int
+    :rtype: list
+    """
+    return list(_get()['lab_groups'].get(theory_group_id, []))
+
+
+def theory_groups(lab_group_id):
+    """The ids of the theory groups that can join a lab group
+
+    :param lab_group_id: The id of the lab group
+    :type lab_group_id: int
+    :rtype: list
+    """
+    return list(_get()['theory_groups'].get(lab_group_id, []))
+
+
+def can_join(theory_group_id, lab_group_id):
+    """If the members of a theory group can join a lab group
+
+    :rtype: bool
+    """
+    return lab_group_id in _get()['lab_groups'].get(theory_group_id, [])
+
+
+def invalidate():
+    """Drops the index, here and in the other workers, now and again when
+    the transaction commits
+    """
+    def drop():
+        _index.clear()
+        cache.set(_version_key(), uuid.uuid4().hex, None)
+    drop()
+    transaction.on_commit(drop)
@@ -1,6 +1,9 @@
 from django import forms
-from core.models import Pair, LabGroup, Student, GroupConstraints
-from django.db.models import Q
+from core import seats, eligibility
+from core.models import (Pair, LabGroup, Student, GroupPreference,
+                         TheoryGroup)
+from django.db import transaction
+from django.db.models import Q, Case, When, Value, BooleanField
 from django.utils.safestring import mark_safe
 
 
@@ -11,39 +14,145 @@ class LabGroupForm(forms.Form):
     labGroup = forms.ModelChoiceField(queryset=None,
                                       label="Available groups:")
 
-    def __init__(self, student, *args, **kwargs):
+    def __init__(self, student, *args, joining=None, **kwargs):
         """A form to display which lab groups a given student can
     apply to
 
-        :param student: The student to check
+        :param student: The student to check (only its ``theoryGroup_id``
+        is read if ``joining`` is given)
         :type student: core.models.Student
+        :param joining: How many students will join (2 if he has a
+        validated pair), computed if it's not given
+        :type joining: int
         """
         super(forms.Form, self).__init__(*args, **kwargs)
 
         # How many users will join?
-        joining = 1
-        # See if the user has a validated pair or not
-        # since that will determine if they can join or not
-        p = Pair.get_pair(student)
-        if p is not None:
-            if p.validated:
-                joining = 2
-
-        # Generate an array with the valid groups
-        validGroups = [LabGroup.objects.filter(
-            Q(groupName=g.labGroup))
-            for g in GroupConstraints.objects
-            .filter(theoryGroup=student.theoryGroup)]
-
-        # Get the groups with space available
-        groups_with_space = []
-        for gQuery in validGroups:
-            for g in gQuery:
-                if g.maxNumberStudents - g.counter > joining:
-                    groups_with_space.append(g.id)
-
-        self.fields['labGroup'].queryset = LabGroup.objects\
-            .filter(id__in=groups_with_space)
+        if joining is None:
+            # See if the user has a validated pair or not
+            # since that will determine if they can join or not
+            joining = 2 if student.pairState == Student.PAIR_VALIDATED\
+                else 1
+
+        # The valid groups with space available, from the shared seat
+        # snapshot, so rendering the form doesn't read the groups table
+        validGroups = eligibility.lab_groups(student.theoryGroup_id)
+        groups_with_space, snapshot = seats.with_space(validGroups, joining)
+
+        field = self.fields['labGroup']
+        # The queryset is only used to validate a submitted form, and it
+        # checks the free seats in the database, not in the snapshot
+        field.queryset = LabGroup.with_space(student.theoryGroup_id,
+                                             joining)
+        field.choices = [('', field.empty_label)] +\
+            [(g, snapshot[g]['name']) for g in groups_with_space]
+
+
+class GroupPreferenceForm(forms.Form):
+    """A form to rank the lab groups a given student can apply to,
+    used during the preference window
+    """
+
+    def __init__(self, student, *args, **kwargs):
+        """A form to rank the lab groups a given student can apply to,
+    with one choice per allowed group, most preferred first
+
+        :param student: The student who ranks the groups
+        :type student: core.models.Student
+        """
+        super(forms.Form, self).__init__(*args, **kwargs)
+        self.student = student
+
+        # The groups come from the eligibility index and the seat snapshot,
+        # once for all the choices
+        group_ids = eligibility.lab_groups(student.theoryGroup_id)
+        snapshot = seats.availability(group_ids)
+        choices = [('', '---------')] + sorted(
+            ((g, snapshot[g]['name']) for g in group_ids if g in snapshot),
+            key=lambda choice: choice[1])
+        for rank in range(1, len(choices)):
+            # Only the first choice is mandatory
+            self.fields['rank_%d' % rank] = forms.TypedChoiceField(
+                choices=choices, coerce=int, empty_value=None,
+                required=rank == 1, label="Choice %d:" % rank)
+
+    def clean(self):
+        cleaned_data = super(GroupPreferenceForm, self).clean()
+        chosen = [g for g in cleaned_data.values() if g is not None]
+        if len(chosen) != len(set(chosen)):
+            raise forms.ValidationError("You can't rank a group twice")
+        return cleaned_data
+
+    def save(self):
+        """Replaces the previous preferences of the student, all at once,
+        and one submit of the student after the other"""
+        chosen = [self.cleaned_data['rank_%d' % rank]
+                  for rank in range(1, len(self.fields) + 1)]
+        with transaction.atomic():
+            list(Student.objects.select_for_update()
+                 .filter(id=self.student.id).values_list('id', flat=True))
+            GroupPreference.objects.filter(student=self.student).delete()
+            GroupPreference.objects.bulk_create([
+                GroupPreference(student=self.student, labGroup_id=g,
+                                rank=rank)
+                for rank, g in enumerate(
+                    (g for g in chosen if g is not None), 1)])
+
+
+class StudentSearchForm(forms.Form):
+    """The filters of the group change page. Every one of them can be
+    answered with an index: the last name (a prefix), the NIE, the theory
+    group and the current lab group.
+    """
+    NO_GROUP = 'none'
+
+    last_name = forms.CharField(required=False, label="Last name starts with",
+                                widget=forms.TextInput(
+                                    attrs={'class': 'w3-input w3-border'}))
+    username = forms.CharField(required=False, label="NIE",
+                               widget=forms.TextInput(
+                                   attrs={'class': 'w3-input w3-border'}))
+    theoryGroup = forms.ModelChoiceField(queryset=TheoryGroup.objects.all(),
+                                         required=False,
+                                         label="Theory group")
+    labGroup = forms.TypedChoiceField(required=False, label="Lab group")
+
+    def __init__(self, *args, **kwargs):
+        """The filters of the group change page, usually bound to the GET
+        parameters
+        """
+        super(forms.Form, self).__init__(*args, **kwargs)
+        # Without a queryset, so the "no group" option can be added
+        field = self.fields['labGroup']
+        field.choices = [('', '---------'), (self.NO_GROUP, 'No group')] +\
+            list(LabGroup.objects.values_list('id', 'groupName'))
+
+    def filter(self, students):
+        """Applies the valid filters to some students
+
+        :param students: The students to filter
+        :type students: django.db.models.QuerySet
+        :return: The students that match every filter
+        :rtype: django.db.models.QuerySet
+        """
+        if not self.is_valid():
+            return students
+        data = self.cleaned_data
+        if data['last_name']:
+            # Case insensitive, since names like "del Val" or "McDonald"
+            # are often typed in lower case (indexed by the 0008 migration)
+            students = students.filter(
+                last_name__istartswith=data['last_name'].strip())
+        if data['username']:
+            students = students.filter(
+                username__startswith=data['username'].strip())
+        if data['theoryGroup'] is not None:
+            students = students.filter(theoryGroup=data['theoryGroup'])
+        if data['labGroup'] == self.NO_GROUP:
+            students = students.filter(labGroup=None)
+        elif data['labGroup']:
+            students = students.filter(labGroup=data['labGroup'])
+        return students
 
 
 class LoginForm(forms.ModelForm):
@@ -101,49 +210,31 @@ class PairForm(forms.Form):
         """
         super(forms.Form, self).__init__(*args, **kwargs)
 
-        they_chosen_us = []
-        eligible_students = set()
-
-        groups_that_can_join = set()
         # Check all groups that can join the same
         # groups as we do
-        if student.labGroup is None:
-            for gc in GroupConstraints.objects.filter(
-                    theoryGroup=student.theoryGroup):
-                groups_that_can_join.add(gc.theoryGroup)
+        if student.labGroup_id is None:
+            groups_that_can_join = [student.theoryGroup_id]\
+                if eligibility.lab_groups(student.theoryGroup_id) else []
         else:
-            for gc in GroupConstraints.objects.filter(
-                    labGroup=student.labGroup):
-                groups_that_can_join.add(gc.theoryGroup)
-
-        # Check all eligible students from the groups
-        # that can join our guy's group
-        for student_to_check in Student.objects\
-                .filter(Q(theoryGroup__in=groups_that_can_join) |
-                        Q(theoryGroup=None)):
-            # Skip the current user
-            if student_to_check.id == student.id:
-                continue
-            # Check his pairs
-            p = Pair.get_pair(student_to_check)
-            if p is not None:
-                if p.validated:
-                    # Don't add them if they have
-                    # a validated pair
-                    continue
-                # Its his request...
-                # ...check if he has chosen us as their mate
-                if p.student2 == student:
-                    they_chosen_us.append(p.student1.id)
-            else:
-                # not in a pair, add them to eligible
-                eligible_students.add(student_to_check.id)
-
-        # Add the queryset in such a way the students that
-        # selected us are shown first on the list
-        # queryset = Student.objects.exclude(id=student.id)
-        queryset = Student.objects.filter(id__in=they_chosen_us)\
-            | Student.objects.filter(id__in=eligible_students)
+            groups_that_can_join = eligibility.theory_groups(
+                student.labGroup_id)
+
+        # Students with a validated pair are not eligible, nor the ones
+        # who requested somebody else. The ones who chose us are.
+        chose_us = Q(pairState=Student.PAIR_REQUESTED, partner=student)
+
+        # A single query, with the students that selected us shown
+        # first on the list, and the groups used by the labels
+        queryset = Student.objects\
+            .filter(Q(theoryGroup__in=groups_that_can_join) |
+                    Q(theoryGroup=None))\
+            .exclude(id=student.id)\
+            .filter(Q(pairState=Student.NO_PAIR) | chose_us)\
+            .annotate(chose_us=Case(When(chose_us, then=Value(True)),
+                                    default=Value(False),
+                                    output_field=BooleanField()))\
+            .order_by('-chose_us', 'last_name', 'first_name')\
+            .select_related('labGroup', 'theoryGroup')
         self.fields['student2'].queryset = queryset
 
 
@@ -175,6 +266,9 @@ class BreakPairForm(forms.Form):
         """
         super(forms.Form, self).__init__(*args, **kwargs)
 
+        # The students are loaded with the pairs, since they're
+        # in the labels
         self.fields['myPair'].queryset = Pair.objects\
             .filter(Q(student1=student) |
-                    Q(student2=student))
+                    Q(student2=student))\
+            .select_related('student1', 'student2')
@@ -0,0 +1,124 @@
+# Assign the lab groups ranked during the preference window
+#
+# execute python manage.py allocategroups [--dry-run]
+
+from collections import Counter, OrderedDict
+from itertools import chain
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Case, When, Value, IntegerField, F
+
+from core import seats, eligibility
+from core.allocation import allocate
+from core.models import Student, LabGroup, GroupPreference, WaitlistEntry
+
+
+class Command(BaseCommand):
+    help = """assign the lab groups ranked by the students without a group,
+           in a single batch that minimizes the ranks given to everyone
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only print the assignment, ' +
+                            'without saving it')
+
+    def handle(self, *args, **kwargs):
+        with transaction.atomic():
+            groups = OrderedDict(
+                (g.id, g) for g in LabGroup.objects.select_for_update()
+                .order_by('id'))
+            units = self.units(groups)
+            seats = {g.id: max(0, g.maxNumberStudents - g.counter)
+                     for g in groups.values()}
+            assignment, unassigned = allocate(units, seats)
+
+            self.report(units, assignment, unassigned, groups)
+            if kwargs['dry_run']:
+                self.stdout.write("Dry run, nothing has been saved")
+                return
+            self.save(assignment)
+
+    def units(self, groups):
+        """Builds the (students, {group: rank}) units to allocate, in the
+        order the preferences were sent. A validated pair is one unit,
+        ranking each group both of them can join with the best rank any of
+        them gave it.
+        """
+        students = {s.id: s for s in Student.objects
+                    .filter(labGroup=None, is_superuser=False)
+                    .only('id', 'theoryGroup', 'partner', 'pairState')}
+        ranks = OrderedDict()
+        for p in GroupPreference.objects.filter(student__in=list(students))\
+                .order_by('id'):
+            # Skip what the constraints don't allow (they may have changed)
+            tg = students[p.student_id].theoryGroup_id
+            if eligibility.can_join(tg, p.labGroup_id):
+                ranks.setdefault(p.student_id, {})[p.labGroup_id] = p.rank
+
+        partner = {s.id: s.partner_id for s in students.values()
+                   if s.pairState == Student.PAIR_VALIDATED}
+
+        units = []
+        done = set()
+        for sid, rank in ranks.items():
+            if sid in done:
+                continue
+            fren = partner.get(sid)
+            if fren is None:
+                units.append(((sid,), rank))
+                done.add(sid)
+            elif fren in students:
+                # Only the groups both of them can join
+                theory_groups = (students[sid].theoryGroup_id,
+                                 students[fren].theoryGroup_id)
+                merged = {}
+                for g, r in chain(rank.items(),
+                                  ranks.get(fren, {}).items()):
+                    if all(eligibility.can_join(tg, g)
+                           for tg in theory_groups):
+                        merged[g] = min(r, merged.get(g, r))
+                units.append(((sid, fren), merged))
+                done.update((sid, fren))
+            # If the partner already has a group, this student should
+            # join him there, it's not up to the allocation
+        return units
+
+    def report(self, units, assignment, unassigned, groups):
+        rank = {}
+        for students, ranked in units:
+            for s in students:
+                rank[s] = ranked
+        got = Counter()
+        for g, students in assignment.items():
+            for s in students:
+                got[rank[s][g]] += 1
+        for r in sorted(got):
+            self.stdout.write("Choice %d: %d students" % (r, got[r]))
+        for g, students in assignment.items():
+            self.stdout.write("%s: +%d students" % (groups[g],
+                                                    len(students)))
+        self.stdout.write("Without group: %d students" %
+                          sum(len(u[0]) for u in unassigned))
+
+    def save(self, assignment):
+        """Writes the assignment back, with a single UPDATE per group plus
+        a single UPDATE for all the counters, in the transaction of
+        :meth:`handle`"""
+        for g, students in assignment.items():
+            if students:
+                Student.objects.filter(id__in=students).update(labGroup=g)
+        added = {g: len(s) for g, s in assignment.items() if s}
+        if added:
+            LabGroup.objects.filter(id__in=added).update(
+                counter=F('counter') + Case(
+                    *[When(id=g, then=Value(n)) for g, n in added.items()],
+                    default=Value(0), output_field=IntegerField()))
+            seats.invalidate(*added)
+        # The unassigned students keep their preferences for the next run,
+        # and their waitlists. The assigned ones don't wait anymore.
+        placed = [s for g in assignment.values() for s in g]
+        GroupPreference.objects.filter(student__in=placed).delete()
+        WaitlistEntry.objects.filter(student__in=placed).delete()
+        self.stdout.write("Groups assigned!")
@@ -0,0 +1,46 @@
+# Grant or revoke the convalidations of every student at once
+#
+# execute python manage.py convalidate
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+
+from core.models import Student, Pair, OtherConstraints
+
+
+class Command(BaseCommand):
+    help = """evaluate the convalidation of every student against the
+           current OtherConstraints, with the same rules as the
+           convalidation page, in two UPDATEs that only write the students
+           whose convalidation changes
+           """
+
+    def handle(self, *args, **kwargs):
+        oc = OtherConstraints.objects.first()
+        if oc is None:
+            raise CommandError("There are no OtherConstraints")
+        granted = self.rules(oc)
+        with transaction.atomic():
+            added = Student.objects.filter(granted)\
+                .filter(convalidationGranted=False)\
+                .update(convalidationGranted=True)
+            removed = Student.objects.exclude(granted)\
+                .filter(convalidationGranted=True)\
+                .update(convalidationGranted=False)
+        self.stdout.write("Convalidations granted: %d" % added)
+        self.stdout.write("Convalidations revoked: %d" % removed)
+
+    def rules(self, oc):
+        """The students that get a convalidation: grades higher than the
+        constraints, no lab group, not the first member of a pair and not
+        in a validated pair
+
+        :rtype: django.db.models.Q
+        """
+        return Q(gradeLabLastYear__gt=oc.minGradeLabConv,
+                 gradeTheoryLastYear__gt=oc.minGradeTheoryConv,
+                 labGroup=None) &\
+            ~Q(id__in=Pair.objects.values('student1')) &\
+            ~Q(id__in=Pair.objects.filter(validated=True)
+               .values('student2'))
@@ -0,0 +1,70 @@
+# How many students would be convalidated with each pair of minimum grades
+#
+# execute python manage.py convalidationwhatif [--theory 0:10:1]
+#                                              [--lab 0:10:1] [--by-group]
+
+from collections import OrderedDict
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.convalidation import threshold_counts
+from core.models import Student
+
+
+def grid(spec):
+    """Parses a ``start:stop:step`` grid of grades, both ends included"""
+    try:
+        start, stop, step = (float(v) for v in spec.split(':'))
+    except ValueError:
+        raise CommandError("%s is not a start:stop:step grid" % spec)
+    if step <= 0 or stop < start:
+        raise CommandError("%s is an empty grid" % spec)
+    return [round(start + i * step, 2)
+            for i in range(int(round((stop - start) / step)) + 1)]
+
+
+class Command(BaseCommand):
+    help = """count the students that each pair of minimum grades
+           (minGradeTheoryConv, minGradeLabConv) would convalidate, from
+           their last year grades, to decide them before setting them in
+           OtherConstraints
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--theory', type=grid, default='0:10:1',
+                            help='Grid of minimum theory grades, as ' +
+                            'start:stop:step (default 0:10:1)')
+        parser.add_argument('--lab', type=grid, default='0:10:1',
+                            help='Grid of minimum lab grades, as ' +
+                            'start:stop:step (default 0:10:1)')
+        parser.add_argument('--by-group', action='store_true',
+                            help='Also count them for each theory group')
+
+    def handle(self, *args, **kwargs):
+        theory, lab = kwargs['theory'], kwargs['lab']
+        # Every grade, in a single query
+        grades = OrderedDict()
+        for group, t, l in Student.objects.filter(is_superuser=False)\
+                .order_by('theoryGroup__groupName')\
+                .values_list('theoryGroup__groupName',
+                             'gradeTheoryLastYear', 'gradeLabLastYear'):
+            grades.setdefault(group, []).append((t, l))
+
+        everyone = [g for group in grades.values() for g in group]
+        self.table("All the students (%d)" % len(everyone),
+                   threshold_counts(everyone, theory, lab), theory, lab)
+        if kwargs['by_group']:
+            for group, students in grades.items():
+                self.table("Theory group %s (%d)" % (group, len(students)),
+                           threshold_counts(students, theory, lab),
+                           theory, lab)
+
+    def table(self, title, counts, theory, lab):
+        """Prints the counts, a row per theory minimum and a column per lab
+        minimum"""
+        self.stdout.write(title)
+        self.stdout.write('theory\\lab' +
+                          ''.join('%7s' % g for g in lab))
+        for t, row in zip(theory, counts):
+            self.stdout.write('%10s' % t + ''.join('%7d' % c for c in row))
+        self.stdout.write('')
@@ -0,0 +1,158 @@
+# Move many students to other lab groups at once, from a csv file
+#
+# execute python manage.py reassigngroups moves.csv [--dry-run]
+
+import csv
+from collections import Counter, OrderedDict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from core import seats, eligibility
+from core.models import Student, LabGroup
+
+
+class Command(BaseCommand):
+    help = """move students to other lab groups, from a csv file with the
+           header NIE,grupo-practicas. Everything is validated first, and
+           either every move is applied, in a single transaction, or none
+           """
+
+    def add_arguments(self, parser):
+        parser.add_argument('moves', type=str,
+                            help='CSV file with the header ' +
+                            'NIE,grupo-practicas (the id of the lab group)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only validate and print the moves, ' +
+                            'without saving them')
+
+    def handle(self, *args, **kwargs):
+        moves = self.read(kwargs['moves'])
+        with transaction.atomic():
+            groups = OrderedDict(
+                (g.id, g) for g in LabGroup.objects.select_for_update()
+                .order_by('id'))
+            assignment, errors = self.validate(moves, groups)
+
+            for error in errors:
+                self.stderr.write(error)
+            self.report(assignment, groups)
+            if errors:
+                raise CommandError("%d errors, nothing has been saved" %
+                                   len(errors))
+            if kwargs['dry_run']:
+                self.stdout.write("Dry run, nothing has been saved")
+                return
+            self.save(assignment)
+
+    def read(self, csvMovesFile):
+        """Reads the (line, NIE, lab group id) moves of the csv file"""
+        moves = []
+        with open(csvMovesFile, newline='') as csvfile:
+            reader = csv.DictReader(csvfile)
+            for row in reader:
+                moves.append((reader.line_num,
+                              row['NIE'].replace(" ", ""),
+                              row['grupo-practicas'].strip()))
+        return moves
+
+    def validate(self, moves, groups):
+        """Checks every move against the constraints, the pairs and the
+        capacity of the groups, with the students and their partners
+        loaded in two queries.
+
+        :return: The {student: (old group, new group)} moves (a validated
+        pair always moves together) and the list of errors
+        :rtype: tuple
+        """
+        fields = ('id', 'username', 'theoryGroup', 'labGroup', 'partner',
+                  'pairState')
+        students = {s.username: s for s in Student.objects
+                    .filter(username__in=[nie for _, nie, _ in moves])
+                    .only(*fields)}
+        partner = {s.id: s.partner_id for s in students.values()
+                   if s.pairState == Student.PAIR_VALIDATED}
+        partners = {s.id: s for s in Student.objects
+                    .filter(id__in=list(partner.values()))
+                    .only(*fields)}
+
+        errors = []
+        assignment = OrderedDict()
+        line_of = {}
+        for line, nie, group in moves:
+            stu = students.get(nie)
+            if stu is None:
+                errors.append("Line %d: %s does not exist" % (line, nie))
+                continue
+            if not group.isdigit() or int(group) not in groups:
+                errors.append("Line %d: %s does not exist" % (line, group))
+                continue
+            group = int(group)
+            # A validated pair moves together, even if only one of them
+            # is in the file
+            moving = [stu]
+            if stu.id in partner:
+                moving.append(partners[partner[stu.id]])
+            for s in moving:
+                if not eligibility.can_join(s.theoryGroup_id, group):
+                    errors.append("Line %d: %s can't join %s" %
+                                  (line, s.username, groups[group]))
+                elif s.id in assignment and assignment[s.id][1] != group:
+                    errors.append("Line %d: %s was already moved to %s " %
+                                  (line, s.username,
+                                   groups[assignment[s.id][1]]) +
+                                  "in line %d" % line_of[s.id])
+                elif s.id not in assignment:
+                    assignment[s.id] = (s.labGroup_id, group)
+                    line_of[s.id] = line
+
+        # The counters after every move, which must fit
+        counters = Counter({g.id: g.counter for g in groups.values()})
+        for old, new in assignment.values():
+            if old != new:
+                counters[new] += 1
+                if old is not None:
+                    counters[old] -= 1
+        for g in groups.values():
+            if counters[g.id] > g.maxNumberStudents:
+                errors.append("%s would have %d students, only %d fit" %
+                              (g, counters[g.id], g.maxNumberStudents))
+        return assignment, errors
+
+    def report(self, assignment, groups):
+        joining, leaving = Counter(), Counter()
+        for old, new in assignment.values():
+            if old != new:
+                joining[new] += 1
+                leaving[old] += 1
+        self.stdout.write("Students moved: %d" % sum(joining.values()))
+        for g in groups.values():
+            if joining[g.id] or leaving[g.id]:
+                self.stdout.write("%s: +%d -%d students" %
+                                  (g, joining[g.id], leaving[g.id]))
+
+    def save(self, assignment):
+        """Writes the moves with a single UPDATE per group, and then
+        recomputes the counter of every affected group with a single
+        UPDATE"""
+        by_group = OrderedDict()
+        affected = set()
+        for sid, (old, new) in assignment.items():
+            if old != new:
+                by_group.setdefault(new, []).append(sid)
+                affected.update((old, new))
+        affected.discard(None)
+        for g, students in by_group.items():
+            Student.objects.filter(id__in=students).update(labGroup=g)
+        if affected:
+            LabGroup.objects.filter(id__in=affected).update(
+                counter=Coalesce(Subquery(
+                    Student.objects.filter(labGroup=OuterRef('pk'))
+                    .order_by().values('labGroup')
+                    .annotate(n=Count('*')).values('n')), Value(0)))
+            seats.invalidate(*affected)
+            # Some seats may have been freed
+            LabGroup.promote_waitlists(sorted(affected))
+        self.stdout.write("Groups changed!")
@@ -0,0 +1,32 @@
+# Generated by Django 2.2.5 on 2026-10-17 17:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='otherconstraints',
+            name='preferenceEndDate',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='GroupPreference',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('labGroup', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.LabGroup')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.Student')),
+            ],
+            options={
+                'ordering': ['student', 'rank'],
+                'unique_together': {('student', 'labGroup'), ('student', 'rank')},
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.5 on 2026-10-17 17:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_grouppreference'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WaitlistEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('labGroup', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='waitlist', to='core.LabGroup')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.Student')),
+            ],
+            options={
+                'ordering': ['id'],
+                'unique_together': {('labGroup', 'student')},
+            },
+        ),
+    ]
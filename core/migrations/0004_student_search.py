@@ -0,0 +1,38 @@
+# Generated by Django 2.2.5 on 2026-10-17 18:00
+
+from django.db import migrations, models
+
+LAST_NAME_INDEX = 'core_user_last_name_idx'
+
+
+def create_last_name_index(apps, schema_editor):
+    # The last name is a field of auth.User, so its index can't be declared
+    # in Student. On PostgreSQL the pattern ops make it usable by the
+    # prefix (LIKE 'x%') searches of the group change page.
+    User = apps.get_model('auth', 'User')
+    quote = schema_editor.quote_name
+    opclass = ' varchar_pattern_ops' \
+        if schema_editor.connection.vendor == 'postgresql' else ''
+    schema_editor.execute('CREATE INDEX %s ON %s (%s%s)' % (
+        quote(LAST_NAME_INDEX), quote(User._meta.db_table),
+        quote('last_name'), opclass))
+
+
+def drop_last_name_index(apps, schema_editor):
+    schema_editor.execute('DROP INDEX %s' %
+                          schema_editor.quote_name(LAST_NAME_INDEX))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_waitlistentry'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='student',
+            index=models.Index(fields=['theoryGroup', 'labGroup'], name='core_student_groups_idx'),
+        ),
+        migrations.RunPython(create_last_name_index, drop_last_name_index),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.5 on 2026-10-17 18:15
+
+from django.db import migrations, models
+
+
+def fill_members(apps, schema_editor):
+    # If the same students have two pairs (only possible with a race before
+    # this migration), each one requested the other, so they are merged
+    # into the oldest, validated, like Pair.save does
+    Pair = apps.get_model('core', 'Pair')
+    kept = {}
+    for pair in Pair.objects.order_by('id'):
+        members = '%d-%d' % tuple(sorted((pair.student1_id,
+                                          pair.student2_id)))
+        if members in kept:
+            Pair.objects.filter(id=kept[members]).update(
+                validated=True, studentBreakRequest=None)
+            pair.delete()
+        else:
+            kept[members] = pair.id
+            Pair.objects.filter(id=pair.id).update(members=members)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_student_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pair',
+            name='members',
+            field=models.CharField(editable=False, max_length=41, null=True, unique=True),
+        ),
+        migrations.RunPython(fill_members, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.5 on 2026-10-17 18:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_partners(apps, schema_editor):
+    # The same as Pair.get_pair: a student has the pair he requested, or
+    # his validated pair
+    Pair = apps.get_model('core', 'Pair')
+    Student = apps.get_model('core', 'Student')
+    for pair in Pair.objects.order_by('validated', 'id'):
+        Student.objects.filter(id=pair.student1_id).update(
+            partner=pair.student2_id, pairState=2 if pair.validated else 1)
+        if pair.validated:
+            Student.objects.filter(id=pair.student2_id).update(
+                partner=pair.student1_id, pairState=2)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_pair_members'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='student',
+            name='pairState',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'No pair'), (1, 'Requested'), (2, 'Validated')], default=0),
+        ),
+        migrations.AddField(
+            model_name='student',
+            name='partner',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.Student'),
+        ),
+        migrations.RunPython(fill_partners, migrations.RunPython.noop),
+    ]
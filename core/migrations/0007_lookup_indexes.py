@@ -0,0 +1,57 @@
+# Generated by Django 2.2.5 on 2026-10-17 18:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+NAME_INDEX = 'core_user_name_idx'
+
+
+def create_name_index(apps, schema_editor):
+    # The order of the group change page (last_name, first_name, id) is in
+    # auth.User, so, like the last name index of 0004, its index can't be
+    # declared in Student. That one has the pattern ops on PostgreSQL,
+    # which can't be used to sort, so this one is needed too.
+    User = apps.get_model('auth', 'User')
+    quote = schema_editor.quote_name
+    schema_editor.execute('CREATE INDEX %s ON %s (%s, %s, %s)' % (
+        quote(NAME_INDEX), quote(User._meta.db_table),
+        quote('last_name'), quote('first_name'), quote('id')))
+
+
+def drop_name_index(apps, schema_editor):
+    schema_editor.execute('DROP INDEX %s' %
+                          schema_editor.quote_name(NAME_INDEX))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_student_partner'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='pair',
+            index=models.Index(fields=['student2', 'validated'], name='core_pair_student2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='groupconstraints',
+            index=models.Index(fields=['theoryGroup', 'labGroup'], name='core_constraint_groups_idx'),
+        ),
+        migrations.RunPython(create_name_index, drop_name_index),
+        migrations.AlterField(
+            model_name='groupconstraints',
+            name='theoryGroup',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.TheoryGroup'),
+        ),
+        migrations.AlterField(
+            model_name='pair',
+            name='student2',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='student2', to='core.Student'),
+        ),
+        migrations.AlterField(
+            model_name='student',
+            name='theoryGroup',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.TheoryGroup'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 2.2.5 on 2026-10-17 19:10
+
+from django.db import migrations
+
+LAST_NAME_INDEX = 'core_user_last_name_idx'
+UPPER_LAST_NAME_INDEX = 'core_user_last_name_upper_idx'
+
+
+def create_upper_last_name_index(apps, schema_editor):
+    # The last name search of the group change page is case insensitive
+    # (istartswith). PostgreSQL compares UPPER(last_name::text) LIKE 'X%',
+    # which only an index on that same expression, with the pattern ops,
+    # can answer. SQLite compares with LIKE, which is already case
+    # insensitive, and uses an index only if it's NOCASE.
+    User = apps.get_model('auth', 'User')
+    quote = schema_editor.quote_name
+    if schema_editor.connection.vendor == 'postgresql':
+        column = 'UPPER(%s::text) varchar_pattern_ops' % quote('last_name')
+    else:
+        column = '%s COLLATE NOCASE' % quote('last_name')
+    schema_editor.execute('DROP INDEX %s' % quote(LAST_NAME_INDEX))
+    schema_editor.execute('CREATE INDEX %s ON %s (%s)' % (
+        quote(UPPER_LAST_NAME_INDEX), quote(User._meta.db_table), column))
+
+
+def drop_upper_last_name_index(apps, schema_editor):
+    User = apps.get_model('auth', 'User')
+    quote = schema_editor.quote_name
+    opclass = ' varchar_pattern_ops' \
+        if schema_editor.connection.vendor == 'postgresql' else ''
+    schema_editor.execute('DROP INDEX %s' % quote(UPPER_LAST_NAME_INDEX))
+    schema_editor.execute('CREATE INDEX %s ON %s (%s%s)' % (
+        quote(LAST_NAME_INDEX), quote(User._meta.db_table),
+        quote('last_name'), opclass))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_upper_last_name_index,
+                             drop_upper_last_name_index),
+    ]
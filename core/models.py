@@ -1,7 +1,15 @@
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction, IntegrityError
 from django.contrib.auth.models import User
 from django.template.defaultfilters import slugify
-from django.db.models import Q
+from django.db.models import Q, F, Case, When, Value
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from collections import Counter
+import time
+
+from core import seats, eligibility, dashboard
 
 
 class OtherConstraints(models.Model):
@@ -12,8 +20,8 @@ class OtherConstraints(models.Model):
 
     .. note::
        This is stored as a single object, which means you need to fetch it
-       with: ``OtherConstraints.objects.first()``. An exception of type
-       `OtherConstraints.DoesNotExist` will be raised if
+       with: ``OtherConstraints.get()`` (cached) or
+       ``OtherConstraints.objects.first()``. Both return `None` if
        there's no "Other Constraints"
 
     :param selectGroupStartDate: The day when the Apply Group page will be open
@@ -24,10 +32,58 @@ class OtherConstraints(models.Model):
     :param minGradeLabConv: The minimum Lab grade from last year to be
     convalidated
     :type minGradeLabConv: django.db.models.FloatField
+    :param preferenceEndDate: If set, from `selectGroupStartDate` until this
+    day the students rank the groups instead of joining them, and the
+    groups are assigned later on with ``manage.py allocategroups``
+    :type preferenceEndDate: django.db.models.DateTimeField
     """
     selectGroupStartDate = models.DateTimeField()
     minGradeTheoryConv = models.FloatField()
     minGradeLabConv = models.FloatField()
+    preferenceEndDate = models.DateTimeField(null=True, blank=True)
+
+    # The states of the group selection, see `group_selection`
+    CLOSED = 'closed'
+    PREFERENCES = 'preferences'
+    OPEN = 'open'
+
+    def get():
+        """Gets the constraints (the single object), from a cache on the
+        process, which is dropped when they are saved or deleted and,
+        since the other processes don't know about it, after
+        `OTHER_CONSTRAINTS_TTL` seconds.
+
+        :return: The constraints, or `None` if there aren't any
+        :rtype: OtherConstraints
+        """
+        entry = _other_constraints.get('entry')
+        now = time.monotonic()
+        if entry is None or entry[1] <= now:
+            entry = (OtherConstraints.objects.first(),
+                     now + getattr(settings, 'OTHER_CONSTRAINTS_TTL', 60))
+            _other_constraints['entry'] = entry
+        return entry[0]
+
+    def group_selection(now=None):
+        """If the students can join the groups, from the cached
+        constraints, so it doesn't need any query
+
+        :param now: The moment to check, defaults to now
+        :type now: datetime.datetime
+        :return: `CLOSED` before `selectGroupStartDate`, `PREFERENCES`
+        until `preferenceEndDate` and `OPEN` after that (or if there are no
+        constraints)
+        :rtype: str
+        """
+        oc = OtherConstraints.get()
+        if oc is None:
+            return OtherConstraints.OPEN
+        now = now or timezone.now()
+        if oc.selectGroupStartDate > now:
+            return OtherConstraints.CLOSED
+        if oc.preferenceEndDate and oc.preferenceEndDate > now:
+            return OtherConstraints.PREFERENCES
+        return OtherConstraints.OPEN
 
     def __str__(self):
         """The string representation for OtherConstraints
@@ -41,6 +97,20 @@ class OtherConstraints(models.Model):
                % (self.minGradeLabConv, self.minGradeTheoryConv)
 
 
+# The cached (constraints, expiry) of OtherConstraints.get, on this process
+_other_constraints = {}
+
+
+@receiver(post_save, sender=OtherConstraints)
+@receiver(post_delete, sender=OtherConstraints)
+def invalidate_other_constraints(sender, instance, **kwargs):
+    """Drops the cached constraints of this process, now and on commit"""
+    def drop():
+        _other_constraints.pop('entry', None)
+    drop()
+    transaction.on_commit(drop)
+
+
 class Teacher(models.Model):
     """The teacher's info.
     Author: Jorge González Gómez
@@ -89,7 +159,9 @@ class LabGroup(models.Model):
         ordering = ['groupName']
 
     def remove_student(self, student):
-        """Removes a student from the current group
+        """Removes a student from the current group. The seat is released
+        with a single conditional UPDATE, so the counter is moved in the
+        database and never read-modified-written from Python.
         Author: Miguel Herrera Martinez
 
         :param student: The Student to remove
@@ -97,16 +169,30 @@ class LabGroup(models.Model):
         :return: True if he was removed, False if he wasn't.
         :rtype: bool
         """
-        if student.labGroup is not self:
+        if student.labGroup_id != self.id:
             return False
+        with transaction.atomic():
+            # Rows are always locked group first, then students, the same
+            # order used by add_student and add_students: this UPDATE locks
+            # the group, then the student is updated, and the promotion
+            # below only locks the waiting students (the group is held)
+            released = LabGroup.objects\
+                .filter(id=self.id, student__id=student.id)\
+                .update(counter=F('counter') - 1)
+            if not released:
+                return False
+            Student.objects.filter(id=student.id).update(labGroup=None)
+            seats.invalidate(self.id)
+            # The seat goes to the waitlist before anyone else can take it
+            LabGroup.promote_waitlists([self.id])
         student.labGroup = None
-        student.save()
         self.counter -= 1
-        self.save()
         return True
 
     def add_student(self, student):
-        """Adds a student to the current group
+        """Adds a student to the current group. The seat is claimed with a
+        single conditional UPDATE (``counter < maxNumberStudents``), so
+        concurrent workers can never oversubscribe the group.
         Author: Miguel Herrera Martinez
 
         :param student: The Student to add
@@ -114,14 +200,163 @@ class LabGroup(models.Model):
         :return: True if he was added, False if the group is full.
         :rtype: bool
         """
-        if self.counter + 1 > self.maxNumberStudents:
-            return False
+        with transaction.atomic():
+            claimed = LabGroup.objects\
+                .filter(id=self.id, counter__lt=F('maxNumberStudents'))\
+                .update(counter=F('counter') + 1)
+            if not claimed:
+                return False
+            Student.objects.filter(id=student.id).update(labGroup=self)
+            # He doesn't wait for any other group anymore
+            WaitlistEntry.objects.filter(student=student.id).delete()
+            seats.invalidate(self.id)
         student.labGroup = self
-        student.save()
         self.counter += 1
-        self.save()
         return True
 
+    def add_students(self, *students):
+        """Adds several students (usually a validated pair) to the current
+        group as a single all-or-nothing operation. Students already in
+        this group don't take a new seat, and the seats of the groups the
+        others leave are released in the same transaction.
+
+        .. note::
+           The involved `LabGroup` rows are locked in ascending id order,
+           and then the `Student` rows, so two concurrent moves can't
+           deadlock each other. The groups the students leave are read
+           from the database, not from the instances, which may be
+           outdated.
+
+        :param students: The Students to add
+        :type students: Student
+        :return: True if all of them were added, False if the group doesn't
+        have enough free seats (nobody is moved in that case).
+        :rtype: bool
+        """
+        ids = sorted(s.id for s in students)
+        with transaction.atomic():
+            while True:
+                current = dict(Student.objects.filter(id__in=ids)
+                               .values_list('id', 'labGroup'))
+                list(LabGroup.objects.select_for_update()
+                     .filter(id__in=[self.id, *current.values()])
+                     .order_by('id').values_list('id', flat=True))
+                # If one of them moved before his group was locked, start
+                # again with his new group
+                locked = dict(Student.objects.select_for_update()
+                              .filter(id__in=ids).order_by('id')
+                              .values_list('id', 'labGroup'))
+                if locked == current:
+                    break
+            moving = [sid for sid in ids if current[sid] != self.id]
+            leaving = Counter(current[sid] for sid in moving
+                              if current[sid] is not None)
+            if moving:
+                claimed = LabGroup.objects\
+                    .filter(id=self.id,
+                            counter__lte=F('maxNumberStudents') -
+                            len(moving))\
+                    .update(counter=F('counter') + len(moving))
+                if not claimed:
+                    return False
+                Student.objects.filter(id__in=moving).update(labGroup=self)
+                # They don't wait for any other group anymore
+                WaitlistEntry.objects.filter(student__in=moving).delete()
+            if leaving:
+                LabGroup.objects.filter(id__in=leaving).update(
+                    counter=F('counter') - Case(
+                        *[When(id=g, then=Value(n))
+                          for g, n in leaving.items()],
+                        default=Value(0),
+                        output_field=models.IntegerField()))
+            seats.invalidate(self.id, *leaving)
+            if leaving:
+                # The seats left go to the waitlists first
+                LabGroup.promote_waitlists(list(leaving))
+        for s in students:
+            s.labGroup = self
+        self.counter += len(moving)
+        return True
+
+    def with_space(theoryGroup, joining=1):
+        """Gets the groups a theory group can join that still have room for
+        the joining students, as a single query that joins the constraints
+        and filters on the free seats in the database.
+
+        :param theoryGroup: The theory group of the students
+        :type theoryGroup: TheoryGroup
+        :param joining: How many students will join (1, or 2 for a pair)
+        :type joining: int
+        :return: The groups, annotated with their ``free`` seats
+        :rtype: django.db.models.QuerySet
+        """
+        return LabGroup.objects\
+            .filter(groupconstraints__theoryGroup=theoryGroup)\
+            .annotate(free=F('maxNumberStudents') - F('counter'))\
+            .filter(free__gt=joining)
+
+    def join_waitlist(self, student):
+        """Puts a student in the waitlist of the current group, if he
+        wasn't already. If he has a validated pair, both will be promoted
+        together.
+
+        :param student: The Student who waits for a seat
+        :type student: Student
+        :return: His position in the waitlist, starting at 1
+        :rtype: int
+        """
+        entry = WaitlistEntry.objects.get_or_create(labGroup=self,
+                                                    student=student)[0]
+        return WaitlistEntry.objects.filter(labGroup=self,
+                                            id__lte=entry.id).count()
+
+    def promote_waitlists(group_ids):
+        """Gives the free seats of some groups to the students waiting for
+        them, in the order they joined the waitlist. Waiting pairs are
+        promoted only if there's room for both, without losing their turn.
+        It's called in the same transaction that released the seats, so
+        nobody else can take them before.
+
+        .. note::
+           It locks the given groups and then the waiting students, so
+           the caller must have locked those groups before any `Student`
+           row it updated (`remove_student` and `add_students` update the
+           group first, `Pair.break_pair` locks it first). Each waitlist
+           is only read until the free seats are filled.
+
+        :param group_ids: The ids of the groups with new free seats
+        :type group_ids: list
+        """
+        # Usually nobody waits, and then nothing is locked (who starts
+        # waiting right now gets the next seat released)
+        if not WaitlistEntry.objects.filter(labGroup__in=group_ids)\
+                .exists():
+            return
+        with transaction.atomic():
+            for lg in LabGroup.objects.select_for_update()\
+                    .filter(id__in=group_ids).order_by('id'):
+                free = lg.maxNumberStudents - lg.counter
+                if free <= 0:
+                    continue
+                for entry in WaitlistEntry.objects.filter(labGroup=lg)\
+                        .select_related('student__partner').order_by('id'):
+                    stu = entry.student
+                    if stu.labGroup_id is not None or\
+                            not eligibility.can_join(stu.theoryGroup_id,
+                                                     lg.id):
+                        # He got a group meanwhile, or isn't allowed
+                        # anymore
+                        entry.delete()
+                        continue
+                    students = [stu]
+                    if stu.pairState == Student.PAIR_VALIDATED:
+                        students.append(stu.partner)
+                    # add_students drops their waitlist entries
+                    if len(students) <= free and lg.add_students(*students):
+                        free -= len(students)
+                    if free <= 0:
+                        break
+
     def save(self, *args, **kwargs):
         self.slug = slugify(self.groupName)
         super(LabGroup, self).save(*args, **kwargs)
@@ -130,6 +365,13 @@ class LabGroup(models.Model):
         return self.groupName
 
 
+@receiver(post_save, sender=LabGroup)
+@receiver(post_delete, sender=LabGroup)
+def invalidate_seats(sender, instance, **kwargs):
+    """Drops the seat availability snapshot of a saved or deleted group"""
+    seats.invalidate(instance.id)
+
+
 class TheoryGroup(models.Model):
     """ Defines the Theory Group model
     Author: Miguel Herrera Martinez
@@ -177,11 +419,23 @@ class Student(User):
     :type gradeLabLastYear: django.db.models.FloatField
     :param convalidationGranted: If he has been given a convalidation this year
     :type convalidationGranted: django.db.models.BooleanField
+    :param partner: The other student of his pair (as
+    :meth:`core.models.Pair.get_pair` would find it), kept by `Pair`
+    :type partner: core.models.Student
+    :param pairState: `NO_PAIR`, `PAIR_REQUESTED` (he requested `partner`)
+    or `PAIR_VALIDATED`, kept by `Pair`
+    :type pairState: django.db.models.PositiveSmallIntegerField
     """
+    # Pair states
+    NO_PAIR = 0
+    PAIR_REQUESTED = 1
+    PAIR_VALIDATED = 2
+
     # Foreign keys of Student
     labGroup = models.ForeignKey(LabGroup, null=True,
                                  on_delete=models.SET_NULL)
-    theoryGroup = models.ForeignKey(TheoryGroup, null=True,
+    # Indexed by core_student_groups_idx, which starts with it
+    theoryGroup = models.ForeignKey(TheoryGroup, null=True, db_index=False,
                                     on_delete=models.SET_NULL)
 
     # Properties inherited by User
@@ -192,11 +446,37 @@ class Student(User):
     gradeLabLastYear = models.FloatField(default=0)
     convalidationGranted = models.BooleanField(default=False)
 
+    # His pair, denormalized so it comes with the student
+    partner = models.ForeignKey('self', null=True, blank=True,
+                                related_name='+',
+                                on_delete=models.SET_NULL)
+    pairState = models.PositiveSmallIntegerField(default=NO_PAIR, choices=[
+        (NO_PAIR, 'No pair'), (PAIR_REQUESTED, 'Requested'),
+        (PAIR_VALIDATED, 'Validated')])
+
     class Meta:
         ordering = ['last_name', 'first_name']
+        # The students of a theory group and lab group, as filtered in
+        # the group change page (the names are indexed in auth_user by the
+        # 0004 and 0007 migrations, since they're fields of User)
+        indexes = [models.Index(fields=['theoryGroup', 'labGroup'],
+                                name='core_student_groups_idx')]
+
+    def save(self, *args, **kwargs):
+        """Saves the student, except his `partner` and `pairState`, which
+        are only written by `Pair`, so an outdated instance can't undo them
+        """
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in ('partner',
+                                                        'pairState')]
+        super(Student, self).save(*args, **kwargs)
 
     def from_user(user: User):
         """Gets a student from any `django.contrib.auth.models.User` user.
+        The ``request.user`` given by :class:`core.backends.StudentBackend`
+        already is the student, so it's returned without any query.
         Author: Jorge González Gómez
 
         :param user: The user to convert to student
@@ -205,6 +485,8 @@ class Student(User):
         not found
         :rtype: Student
         """
+        if isinstance(user, Student):
+            return user
         return Student.objects.get(id=user.id)
 
     def __str__(self):
@@ -224,6 +506,8 @@ class Pair(models.Model):
     :type studentBreakRequest: core.models.Student
     :param validated: If the pair is validated or if it isn't
     :type validated: django.db.models.BooleanField
+    :param members: The ids of both students, lowest first, unique
+    :type members: django.db.models.CharField
     """
 
     # Save function return codes
@@ -239,7 +523,8 @@ class Pair(models.Model):
                                     null=False,
                                     related_name="student1",
                                     on_delete=models.CASCADE)
-    student2 = models.ForeignKey(Student, null=False,
+    # Indexed by core_pair_student2_idx, which starts with it
+    student2 = models.ForeignKey(Student, null=False, db_index=False,
                                  related_name="student2",
                                  on_delete=models.CASCADE)
 
@@ -250,10 +535,16 @@ class Pair(models.Model):
 
     # Properties of Pair
     validated = models.BooleanField(default=False)
+    # The ids of both students, lowest first, so that the database rejects
+    # a second pair of the same students in any order (set by save)
+    members = models.CharField(max_length=41, null=True, unique=True,
+                               editable=False)
 
     def get_pair(student: Student):
         """Gets the pair for a student, be it if he's
-        the second or the first student
+        the second or the first student. If only the state of the pair is
+        needed, `Student.pairState` and `Student.partner` tell the same
+        without a query.
         Author: Jorge González Gómez
 
         :param student: The class:`core.models.Student` to query
@@ -281,44 +572,59 @@ class Pair(models.Model):
                  * `Pair.SECOND_HAS_PAIR` if student2 has another pair
         :rtype: int
         """
+        self.members = '%d-%d' % tuple(
+            sorted((self.student1_id, self.student2_id)))
+        try:
+            with transaction.atomic():
+                return self._save(*args, **kwargs)
+        except IntegrityError:
+            # Someone saved a pair of one of them at the same time (only
+            # possible where the locks below don't exist, e.g. SQLite), so
+            # the checks are done again, now that his pair can be seen
+            with transaction.atomic():
+                return self._save(*args, **kwargs)
+
+    def _save(self, *args, **kwargs):
+        """The checks and the write of :meth:`save`, in a fixed number of
+        statements: locking both students, reading their pairs, and an
+        INSERT or UPDATE. Must be called in a transaction."""
+        # Lock both students, lowest id first like everywhere else, so two
+        # requests between the same students are done one after the other
+        ids = sorted((self.student1_id, self.student2_id))
+        list(Student.objects.select_for_update().filter(id__in=ids)
+             .order_by('id').values_list('id', flat=True))
+
         if self.validated is False:
+            # The pair requested by each of them, and the validated pair of
+            # student2 (the only ones that matter), in a single query
+            own_pair = other_pair = None
+            for p in Pair.objects.filter(
+                    Q(student1__in=ids) |
+                    Q(student2=self.student2_id, validated=True)):
+                if p.student1_id == self.student1_id:
+                    own_pair = p
+                else:
+                    other_pair = p
+
             # Check if this user already requested another
             # pair. If he did, don't save this one.
-
-            # If it returned anything not equal to self,
-            # he already requested another pair
-            try:
-                own_pair = Pair.objects.get(student1=self.student1)
-                if own_pair.student2 != self.student2:
-                    # you have a different pair
-                    return Pair.YOU_HAVE_PAIR
-            except Pair.DoesNotExist:
-                pass
-            # See if student2 already has a pair
-            # where his student2 matches self.student1
-
-            # Check if another pair exists beforehand
-            other_pair = Pair.get_pair(self.student2)
+            if own_pair is not None and\
+                    own_pair.student2_id != self.student2_id:
+                # you have a different pair
+                return Pair.YOU_HAVE_PAIR
 
             # It exists, check if said student wants
             # to be with self.student1 too
-            if other_pair is not None:
-                if other_pair.id == self.id:
-                    # Same pair, just skip the logic
-                    pass
-                # If the following statement is false, create
-                # this new pair by just continuing
-                # after the except
-                elif other_pair.student2 == self.student1:
+            if other_pair is not None and other_pair.id != self.id:
+                if other_pair.student2_id == self.student1_id:
                     # Validate the other pair (first created)
                     # and don't save this one
                     other_pair.validated = True
-                    other_pair.save()
+                    super(Pair, other_pair).save()
                     return Pair.OK
-                else:
-                    # the other guy has another request
-                    # (doesn't matter if it's not validated)
-                    return Pair.SECOND_HAS_PAIR
+                # the other guy has another request
+                # (doesn't matter if it's not validated)
+                return Pair.SECOND_HAS_PAIR
         # Save this current pair
         super(Pair, self).save(*args, **kwargs)
         return Pair.OK
@@ -330,20 +636,75 @@ class Pair(models.Model):
         Args:
             student (Student): The student who breaks the pair
         """
-        if self.validated:
-            self.studentBreakRequest = student
-            self.validated = False
-            super(Pair, self).save()
-        else:
-            self.delete()
+        with transaction.atomic():
+            # Now they may fit alone where they waited for two seats. Those
+            # groups are locked before the students are updated, in the
+            # same order as add_students, so they can't deadlock
+            waiting = sorted(set(
+                WaitlistEntry.objects
+                .filter(student__in=[self.student1_id, self.student2_id])
+                .values_list('labGroup', flat=True)))
+            list(LabGroup.objects.select_for_update()
+                 .filter(id__in=waiting).order_by('id')
+                 .values_list('id', flat=True))
+            if self.validated:
+                self.studentBreakRequest = student
+                self.validated = False
+                super(Pair, self).save()
+            else:
+                self.delete()
+            if waiting:
+                LabGroup.promote_waitlists(waiting)
 
     class Meta:
         ordering = ['student1__id', 'student2__id']
+        # The validated pair of the second student, as get_pair and save
+        # look it up
+        indexes = [models.Index(fields=['student2', 'validated'],
+                                name='core_pair_student2_idx')]
 
     def __str__(self):
         return f'{self.student1} - {self.student2}'
 
 
+@receiver(post_save, sender=Pair)
+def update_partners(sender, instance, **kwargs):
+    """Keeps `Student.partner` and `Student.pairState` of both students of
+    a saved pair, in the same transaction and with a single UPDATE"""
+    s1, s2 = instance.student1_id, instance.student2_id
+    if instance.validated:
+        Student.objects.filter(id__in=[s1, s2]).update(
+            partner=Case(When(id=s1, then=Value(s2)), default=Value(s1),
+                         output_field=models.IntegerField()),
+            pairState=Student.PAIR_VALIDATED)
+    else:
+        # Only a request of student1. student2 loses it if it was
+        # validated until now (a broken pair), not if it's his own request
+        Student.objects.filter(Q(id=s1) | Q(id=s2, partner=s1)).update(
+            partner=Case(When(id=s1, then=Value(s2)), default=None,
+                         output_field=models.IntegerField()),
+            pairState=Case(When(id=s1, then=Value(Student.PAIR_REQUESTED)),
+                           default=Value(Student.NO_PAIR),
+                           output_field=models.IntegerField()))
+
+
+@receiver(post_delete, sender=Pair)
+def clear_partners(sender, instance, **kwargs):
+    """Clears `Student.partner` and `Student.pairState` of the students of
+    a deleted pair"""
+    s1, s2 = instance.student1_id, instance.student2_id
+    Student.objects.filter(Q(id=s1, partner=s2) | Q(id=s2, partner=s1))\
+        .update(partner=None, pairState=Student.NO_PAIR)
+
+
+@receiver(post_save, sender=Pair)
+@receiver(post_delete, sender=Pair)
+def invalidate_dashboard(sender, instance, **kwargs):
+    """Drops the cached home page of both members of a saved or deleted
+    pair"""
+    dashboard.invalidate(instance.student1_id, instance.student2_id)
+
+
 class GroupConstraints(models.Model):
     """The group constraints, used to see who can join a
     `LabGroup` in particular
@@ -355,12 +716,73 @@ class GroupConstraints(models.Model):
     :type labGroup: core.models.LabGroup
     """
     # Foreign keys of GroupConstraints
-    theoryGroup = models.ForeignKey(TheoryGroup, null=True,
+    # Indexed by core_constraint_groups_idx, which starts with it
+    theoryGroup = models.ForeignKey(TheoryGroup, null=True, db_index=False,
                                     on_delete=models.SET_NULL)
     labGroup = models.OneToOneField(LabGroup, on_delete=models.CASCADE)
 
     class Meta:
         ordering = ['labGroup', 'theoryGroup']
+        # The lab groups of a theory group, read from the index alone by
+        # LabGroup.with_space and the eligibility index
+        indexes = [models.Index(fields=['theoryGroup', 'labGroup'],
+                                name='core_constraint_groups_idx')]
 
     def __str__(self):
         return f'{self.theoryGroup} - {self.labGroup}'
+
+
+@receiver(post_save, sender=GroupConstraints)
+@receiver(post_delete, sender=GroupConstraints)
+@receiver(post_delete, sender=TheoryGroup)
+def invalidate_eligibility(sender, instance, **kwargs):
+    """Drops the eligibility index when the constraints change (deleting
+    a theory group changes them without saving them)"""
+    eligibility.invalidate()
+
+
+class GroupPreference(models.Model):
+    """A lab group ranked by a student during the preference window
+
+    :param student: The student who ranked the group
+    :type student: core.models.Student
+    :param labGroup: The ranked Lab group
+    :type labGroup: core.models.LabGroup
+    :param rank: Its position in the student's list, starting at 1
+    :type rank: django.db.models.PositiveSmallIntegerField
+    """
+    # Foreign keys of GroupPreference
+    student = models.ForeignKey(Student, on_delete=models.CASCADE)
+    labGroup = models.ForeignKey(LabGroup, on_delete=models.CASCADE)
+
+    # Properties of GroupPreference
+    rank = models.PositiveSmallIntegerField()
+
+    class Meta:
+        ordering = ['student', 'rank']
+        unique_together = [['student', 'rank'], ['student', 'labGroup']]
+
+    def __str__(self):
+        return f'{self.student} - {self.rank}. {self.labGroup}'
+
+
+class WaitlistEntry(models.Model):
+    """A student waiting for a seat in a full `LabGroup`. The waitlist of a
+    group is ordered by arrival (the entry's id)
+
+    :param labGroup: The full Lab group
+    :type labGroup: core.models.LabGroup
+    :param student: The student who waits
+    :type student: core.models.Student
+    """
+    # Foreign keys of WaitlistEntry
+    labGroup = models.ForeignKey(LabGroup, related_name="waitlist",
+                                 on_delete=models.CASCADE)
+    student = models.ForeignKey(Student, on_delete=models.CASCADE)
+
+    class Meta:
+        ordering = ['id']
+        unique_together = [['labGroup', 'student']]
+
+    def __str__(self):
+        return f'{self.labGroup} - {self.student}'
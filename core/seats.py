@@ -0,0 +1,115 @@
+"""Seat availability snapshot of the lab groups, shared by every worker.
+
+Each `LabGroup` has its own entry in Django's cache framework (the cache
+named by ``SEAT_CACHE``) with its name and free seats, so the pages that
+only display the groups don't need to read the ``core_labgroup`` table.
+
+The entries are keyed with a global seat version, which every path that
+changes a counter bumps through :meth:`invalidate`, right away and again
+when the transaction commits. A reader that read a counter before the
+change was committed can only store it under the version it read, which
+is outdated once the change commits, so nobody reads it after that. Anyone
+watching the seats only needs to read that number to know if something
+changed.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+
+VERSION_KEY = 'seats:version'
+
+
+def _cache():
+    return caches[getattr(settings, 'SEAT_CACHE', 'default')]
+
+
+def _key(group_id, version):
+    # The database name is part of the key, so that the test databases
+    # never share the snapshot with the real one
+    return 'seats:%s:%d:%d' % (connection.settings_dict['NAME'], version,
+                               group_id)
+
+
+def _version_key():
+    return '%s:%s' % (VERSION_KEY, connection.settings_dict['NAME'])
+
+
+def availability(group_ids):
+    """Gets the snapshot of some groups, loading the missing ones from the
+    database with a single query.
+
+    :param group_ids: The ids of the groups
+    :type group_ids: list
+    :return: A ``{id: {'name': groupName, 'free': free seats}}`` dict
+    :rtype: dict
+    """
+    from core.models import LabGroup
+
+    current = version()
+    keys = {_key(g, current): g for g in group_ids}
+    cached = _cache().get_many(list(keys))
+    snapshot = {keys[k]: v for k, v in cached.items()}
+    missing = [g for g in group_ids if g not in snapshot]
+    if missing:
+        loaded = {}
+        for g in LabGroup.objects.filter(id__in=missing)\
+                .values('id', 'groupName', 'counter', 'maxNumberStudents'):
+            snapshot[g['id']] = loaded[_key(g['id'], current)] = {
+                'name': g['groupName'],
+                'free': g['maxNumberStudents'] - g['counter']}
+        _cache().set_many(loaded,
+                          getattr(settings, 'SEAT_CACHE_TIMEOUT', 60))
+    return snapshot
+
+
+def with_space(group_ids, joining):
+    """Gets the groups with room for a student, or for a pair
+
+    :param group_ids: The ids of the groups to check
+    :type group_ids: list
+    :param joining: How many students will join (1, or 2 for a pair)
+    :type joining: int
+    :return: The ids of the groups with space, sorted by name, and the
+    snapshot of all the given groups
+    :rtype: tuple
+    """
+    snapshot = availability(group_ids)
+    return sorted((g for g in group_ids
+                   if g in snapshot and snapshot[g]['free'] > joining),
+                  key=lambda g: snapshot[g]['name']), snapshot
+
+
+def _start():
+    # The cache may evict the version. It starts again from a random
+    # number, not from 0, so it can't repeat one already used in a key
+    return uuid.uuid4().int >> 80
+
+
+def version():
+    """The current seat version, which changes with every counter change
+
+    :rtype: int
+    """
+    return _cache().get_or_set(_version_key(), _start, None)
+
+
+def _bump():
+    try:
+        _cache().incr(_version_key())
+    except ValueError:
+        _cache().add(_version_key(), _start(), None)
+
+
+def invalidate(*group_ids):
+    """Outdates the snapshot of the given groups (with every other one), now
+    and on commit
+
+    :param group_ids: The ids of the groups whose counter changed
+    :type group_ids: int
+    """
+    if all(g is None for g in group_ids):
+        return
+    _bump()
+    transaction.on_commit(_bump)
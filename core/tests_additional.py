@@ -1,15 +1,38 @@
 import re
 from decimal import Decimal
 import datetime
+import importlib
+import json
+import random
+import tempfile
+import time
+from io import StringIO
+from unittest import mock
 
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
-from django.test import Client, TestCase
+from django.test import Client, TestCase, override_settings
 from django.urls import reverse
+from django.core.management import call_command, CommandError
+from django.contrib.auth.models import User
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
 
+from core import admission, dashboard, eligibility, seats, views
+from core.forms import (LabGroupForm, PairForm, BreakPairForm,
+                        GroupPreferenceForm, StudentSearchForm)
+from core.seats import invalidate
+from core.allocation import allocate
+from core.convalidation import threshold_counts
 from core.management.commands.populate import Command
+from core.management.commands.allocategroups import \
+    Command as AllocateCommand
 from core.models import (Student, OtherConstraints,
                          Pair, TheoryGroup, GroupConstraints,
-                         LabGroup)
+                         LabGroup, GroupPreference, WaitlistEntry)
 
 ###################
 
@@ -36,3 +59,1248 @@ LAST_NAME_4 = "name4"
 
 USER_SESSION_ID = "_auth_user_id"
 ###################
+
+
+# A cache of their own (configured like the real one), emptied before each
+# test, so the tests don't see the entries of the others
+@override_settings(CACHES={'default': dict(settings.CACHES['default'],
+                                           LOCATION=tempfile.mkdtemp())})
+class AdditionalBaseTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user1 = Student.objects.create_user(
+            id=FIRST_STUDENT_ID,
+            username=USERNAME_1,
+            password=PASSWORD_1,
+            first_name=FIRST_NAME_1,
+            last_name=LAST_NAME_1)
+        self.user2 = Student.objects.create_user(
+            id=FIRST_STUDENT_ID+1,
+            username=USERNAME_2,
+            password=PASSWORD_2,
+            first_name=FIRST_NAME_2,
+            last_name=LAST_NAME_2)
+        self.user3 = Student.objects.create_user(
+            id=FIRST_STUDENT_ID+2,
+            username=USERNAME_3,
+            password=PASSWORD_3,
+            first_name=FIRST_NAME_3,
+            last_name=LAST_NAME_3)
+        self.populate = Command()
+        self.populate.teacher()
+        self.populate.otherconstrains()
+        self.populate.theorygroup()
+        self.populate.labgroup()
+        self.populate.groupconstraints()
+        # warm the eligibility index, as in a running server
+        eligibility.lab_groups(None)
+
+    def tearDown(self):
+        self.populate.cleanDataBase()
+
+    @classmethod
+    def bulk_students(cls, n, theoryGroup):
+        """Creates n students quickly (bulk_create doesn't support
+        multi-table inheritance)"""
+        first = User.objects.order_by('-id').values_list('id', flat=True)\
+            .first() + 1
+        User.objects.bulk_create([
+            User(id=first + i, username="bulk_%d" % (first + i),
+                 first_name="bulk", last_name="%05d" % i)
+            for i in range(n)])
+        # quoted, or PostgreSQL folds the camelCase columns to lowercase
+        quote = connection.ops.quote_name
+        columns = ('user_ptr_id', 'theoryGroup_id', 'gradeTheoryLastYear',
+                   'gradeLabLastYear', 'convalidationGranted', 'pairState')
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO %s (%s) VALUES (%%s, %%s, 0, 0, %%s, 0)" % (
+                    quote(Student._meta.db_table),
+                    ", ".join(quote(c) for c in columns)),
+                [(first + i, theoryGroup.id, False) for i in range(n)])
+
+    def open_group_selection(self):
+        o = OtherConstraints.objects.all().first()
+        now = datetime.datetime.now()
+        now = timezone.make_aware(now, timezone.get_current_timezone())
+        o.selectGroupStartDate = now
+        o.save()
+
+
+class SeatReservationTests(AdditionalBaseTest):
+    "Seat claims and releases are conditional updates in the database"
+
+    def test_add_student_claims_seat(self):
+        lg = LabGroup.objects.all().first()
+        lg.counter = 0
+        lg.maxNumberStudents = 1
+        lg.save()
+        self.assertTrue(lg.add_student(self.user1))
+        # a stale copy of the group can't oversubscribe it
+        stale = LabGroup.objects.get(pk=lg.id)
+        stale.counter = 0
+        self.assertFalse(stale.add_student(self.user2))
+        self.assertEqual(LabGroup.objects.get(pk=lg.id).counter, 1)
+        self.assertIsNone(Student.objects.get(pk=self.user2.id).labGroup)
+        self.assertEqual(Student.objects.get(pk=self.user1.id).labGroup_id,
+                         lg.id)
+
+    def test_remove_student_releases_seat(self):
+        lg = LabGroup.objects.all().first()
+        lg.counter = 0
+        lg.save()
+        lg.add_student(self.user1)
+        user = Student.objects.get(pk=self.user1.id)
+        self.assertFalse(lg.remove_student(self.user2))
+        self.assertTrue(LabGroup.objects.get(pk=lg.id)
+                        .remove_student(user))
+        self.assertFalse(LabGroup.objects.get(pk=lg.id)
+                         .remove_student(user))
+        self.assertEqual(LabGroup.objects.get(pk=lg.id).counter, 0)
+        self.assertIsNone(Student.objects.get(pk=self.user1.id).labGroup)
+
+
+class PairReservationTests(AdditionalBaseTest):
+    "A validated pair is moved as a single all-or-nothing operation"
+
+    def setUp(self):
+        super().setUp()
+        self.open_group_selection()
+        self.theoryGroup = TheoryGroup.objects.get(id=126)
+        for user in (self.user1, self.user2):
+            user.theoryGroup = self.theoryGroup
+            user.save()
+        Pair(student1=self.user1, student2=self.user2, validated=True).save()
+        self.labGroups = [gc.labGroup for gc in GroupConstraints.objects
+                          .filter(theoryGroup=self.theoryGroup)]
+
+    def test_pair_moves_together(self):
+        old, new = self.labGroups[0], self.labGroups[1]
+        old.counter = 0
+        old.save()
+        new.counter = 0
+        new.save()
+        self.assertTrue(old.add_students(self.user1, self.user2))
+        user1 = Student.objects.get(pk=self.user1.id)
+        user2 = Student.objects.get(pk=self.user2.id)
+        with self.assertNumQueries(10):
+            self.assertTrue(new.add_students(user1, user2))
+        self.assertEqual(LabGroup.objects.get(pk=old.id).counter, 0)
+        self.assertEqual(LabGroup.objects.get(pk=new.id).counter, 2)
+        self.assertEqual(Student.objects.filter(labGroup=new).count(), 2)
+
+    def test_stale_copies(self):
+        # two outdated copies of a student in a group, moved one after
+        # the other, only release his seat once
+        g0, g1, g2 = self.labGroups[:3]
+        for g in (g0, g1, g2):
+            g.counter = 0
+            g.save()
+        g0.add_students(self.user3)
+        first = Student.objects.get(pk=self.user3.id)
+        second = Student.objects.get(pk=self.user3.id)
+        self.assertTrue(g1.add_students(first))
+        self.assertTrue(g2.add_students(second))
+        for g, n in ((g0, 0), (g1, 0), (g2, 1)):
+            self.assertEqual(LabGroup.objects.get(pk=g.id).counter, n)
+            self.assertEqual(Student.objects.filter(labGroup=g).count(), n)
+
+    def test_full_group_keeps_pair(self):
+        old, new = self.labGroups[0], self.labGroups[1]
+        old.counter = 0
+        old.save()
+        old.add_students(self.user1, self.user2)
+        new.counter = new.maxNumberStudents - 1
+        new.save()
+        self.client.force_login(self.user1)
+        self.client.post(reverse("applygroup"),
+                         data={"labGroup": new.id}, follow=True)
+        self.assertEqual(LabGroup.objects.get(pk=old.id).counter, 2)
+        self.assertEqual(LabGroup.objects.get(pk=new.id).counter,
+                         new.maxNumberStudents - 1)
+        self.assertEqual(Student.objects.filter(labGroup=old).count(), 2)
+
+    def test_groupchange_moves_pair(self):
+        lg = self.labGroups[0]
+        lg.counter = 0
+        lg.save()
+        admin = Student.objects.create_superuser("admin", "a@a.es", "admin")
+        self.client.force_login(admin)
+        self.client.post(reverse("groupchange"),
+                         data={"labGroup": lg.id,
+                               "student": self.user2.id}, follow=True)
+        self.assertEqual(LabGroup.objects.get(pk=lg.id).counter, 2)
+        self.assertEqual(Student.objects.filter(labGroup=lg).count(), 2)
+
+
+@override_settings(ADMISSION_SLOTS=1,
+                   ADMISSION_DIR=tempfile.mkdtemp())
+class AdmissionTests(AdditionalBaseTest):
+    "Seat requests above the admission slots go to the waiting room"
+
+    def test_waiting_room(self):
+        self.open_group_selection()
+        self.user1.theoryGroup = TheoryGroup.objects.get(id=126)
+        self.user1.save()
+        self.client.force_login(self.user1)
+        data = {"labGroup": 1261}
+        slot = admission.acquire_slot()
+        try:
+            # only the session and the user
+            with self.assertNumQueries(2):
+                response = self.client.post(reverse("applygroup"),
+                                            data=data)
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response["Retry-After"], "5")
+            self.assertIn(admission.TICKET_COOKIE, response.cookies)
+            self.assertRegex(response.content.decode("utf-8"),
+                             r"Waiting room")
+        finally:
+            admission.release_slot(slot)
+        response = self.client.post(reverse("applygroup"), data=data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Student.objects.get(pk=self.user1.id).labGroup_id,
+                         1261)
+
+    @override_settings(ADMISSION_DIR=tempfile.mkdtemp())
+    def test_abandoned_tickets(self):
+        self.client.force_login(self.user1)
+        slot = admission.acquire_slot()
+        try:
+            # three students left the waiting room without being served
+            for i in range(3):
+                admission._tickets(take=True)
+            response = self.client.post(reverse("applygroup"))
+            self.assertEqual(response.context["position"], 4)
+            # once nobody has waited for a while, the queue starts again,
+            # and the old tickets are given a new one
+            later = time.time() + 120
+            with mock.patch("core.admission.time.time", return_value=later):
+                self.assertEqual(admission._tickets(), (0, 0))
+                response = self.client.post(reverse("applygroup"))
+            self.assertEqual(response.context["position"], 1)
+            self.assertEqual(response.cookies[admission.TICKET_COOKIE].value,
+                             "0")
+        finally:
+            admission.release_slot(slot)
+
+    def test_anonymous(self):
+        slot = admission.acquire_slot()
+        try:
+            # sent to log in, without a ticket
+            response = self.client.post(reverse("applygroup"),
+                                        data={"labGroup": 1261})
+            self.assertEqual(response.status_code, 302)
+            self.assertNotIn(admission.TICKET_COOKIE, response.cookies)
+        finally:
+            admission.release_slot(slot)
+
+
+class AllocationTests(AdditionalBaseTest):
+    "Groups ranked during the preference window are assigned in a batch"
+
+    def test_allocate(self):
+        units = [((1,), {10: 1, 20: 2}),
+                 ((2,), {10: 1, 20: 2}),
+                 ((3, 4), {10: 1}),
+                 ((5,), {20: 1})]
+        assignment, unassigned = allocate(units, {10: 2, 20: 2})
+        # the pair is kept together, and nobody is left out
+        self.assertEqual(sorted(assignment[10]), [3, 4])
+        self.assertEqual(sorted(assignment[20]), [1, 5])
+        self.assertEqual(unassigned, [((2,), {10: 1, 20: 2})])
+
+    def test_allocate_thousands(self):
+        # each theory group may join its own 4 lab groups, as
+        # GroupConstraints only allows one theory group per lab group
+        groups = {g: 120 for g in range(40)}
+        units = []
+        for s in range(5000):
+            tg = s % 10
+            ranked = random.sample(range(4 * tg, 4 * tg + 4), 4)
+            units.append(((s,), {g: r for r, g in enumerate(ranked, 1)}))
+        start = time.time()
+        assignment, unassigned = allocate(units, groups)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(sum(len(s) for s in assignment.values()) +
+                         len(unassigned), 5000)
+        for g, students in assignment.items():
+            self.assertLessEqual(len(students), groups[g])
+
+    def test_preference_window(self):
+        self.open_group_selection()
+        o = OtherConstraints.objects.all().first()
+        o.preferenceEndDate = o.selectGroupStartDate +\
+            datetime.timedelta(1)
+        o.save()
+        tg = TheoryGroup.objects.get(id=126)
+        for user in (self.user1, self.user2, self.user3):
+            user.theoryGroup = tg
+            user.save()
+        lg = LabGroup.objects.get(id=1261)
+        lg.counter = lg.maxNumberStudents - 1
+        lg.save()
+        for user in (self.user1, self.user2, self.user3):
+            self.client.force_login(user)
+            self.client.post(reverse("applygroup"),
+                             data={"rank_1": 1261, "rank_2": 1262})
+        self.assertEqual(GroupPreference.objects.count(), 6)
+        # a group can't be ranked twice
+        self.client.post(reverse("applygroup"),
+                         data={"rank_1": 1261, "rank_2": 1261})
+        self.assertEqual(GroupPreference.objects
+                         .filter(student=self.user3).count(), 2)
+        self.assertIsNone(Student.objects.get(pk=self.user1.id).labGroup)
+
+        # user1 also waits for a full group
+        full = LabGroup.objects.get(id=1263)
+        WaitlistEntry.objects.create(labGroup=full, student=self.user1)
+        call_command("allocategroups", "--dry-run", stdout=StringIO())
+        self.assertEqual(Student.objects.filter(labGroup=None,
+                                                id__gte=FIRST_STUDENT_ID)
+                         .count(), 3)
+        call_command("allocategroups", stdout=StringIO())
+        self.assertEqual(Student.objects.filter(labGroup=lg).count(), 1)
+        self.assertEqual(Student.objects.filter(labGroup_id=1262).count(), 2)
+        self.assertEqual(LabGroup.objects.get(id=1261).counter,
+                         lg.maxNumberStudents)
+        self.assertEqual(GroupPreference.objects.count(), 0)
+        self.assertEqual(WaitlistEntry.objects.count(), 0)
+
+        # with their groups, they can't move into the free seats until the
+        # window closes
+        self.client.force_login(self.user1)
+        before = Student.objects.get(pk=self.user1.id).labGroup_id
+        other = 1261 if before != 1261 else 1262
+        response = self.client.post(reverse("applygroup"),
+                                    data={"labGroup": other})
+        self.assertContains(response, "until they are assigned to everyone")
+        self.assertEqual(Student.objects.get(pk=self.user1.id).labGroup_id,
+                         before)
+
+    def test_preference_form_queries(self):
+        self.user1.theoryGroup = TheoryGroup.objects.get(id=126)
+        str(GroupPreferenceForm(self.user1))
+        # the groups come from the eligibility index and the seat snapshot
+        with self.assertNumQueries(0):
+            html = str(GroupPreferenceForm(self.user1))
+        self.assertEqual(html.count("<select"), 3)
+        self.assertEqual(html.count('value="1261"'), 3)
+
+    def test_pair_ranks_both_can_join(self):
+        self.user1.theoryGroup = TheoryGroup.objects.get(id=126)
+        self.user1.save()
+        self.user2.theoryGroup = TheoryGroup.objects.get(id=127)
+        self.user2.save()
+        Pair(student1=self.user1, student2=self.user2, validated=True).save()
+        # each one ranks a group only his theory group can join
+        only_126 = eligibility.lab_groups(126)[0]
+        only_127 = eligibility.lab_groups(127)[0]
+        GroupPreference.objects.create(student=self.user1,
+                                       labGroup_id=only_126, rank=1)
+        GroupPreference.objects.create(student=self.user2,
+                                       labGroup_id=only_127, rank=1)
+        groups = {g.id: g for g in LabGroup.objects.all()}
+        self.assertEqual(AllocateCommand().units(groups),
+                         [((self.user1.id, self.user2.id), {})])
+
+
+class SeatSnapshotTests(AdditionalBaseTest):
+    "The lab group form reads the free seats from the shared cache"
+
+    def test_form_uses_snapshot(self):
+        self.user1.theoryGroup = TheoryGroup.objects.get(id=126)
+        self.user1.save()
+        str(LabGroupForm(self.user1))
+        with self.assertNumQueries(0):
+            # no pair (it comes with the student), constraint nor lab group
+            html = str(LabGroupForm(self.user1))
+        self.assertIn("1261", html)
+
+        lg = LabGroup.objects.get(id=1261)
+        lg.counter = lg.maxNumberStudents
+        lg.save()
+        self.assertNotIn("1261", str(LabGroupForm(self.user1)))
+
+        # the counter paths keep it up to date too
+        lg = LabGroup.objects.get(id=1262)
+        lg.counter = lg.maxNumberStudents - 2
+        lg.save()
+        self.assertIn("1262", str(LabGroupForm(self.user1)))
+        lg.add_student(self.user2)
+        self.assertNotIn("1262", str(LabGroupForm(self.user1)))
+
+    def test_stale_reader(self):
+        # a counter changes, and before the commit somebody reads the old
+        # one and stores it
+        seats.invalidate(1261)
+        cache.set(seats._key(1261, seats.version()),
+                  {"name": "1261", "free": 99})
+        # the commit outdates it
+        seats._bump()
+        self.assertNotEqual(seats.availability([1261])[1261]["free"], 99)
+
+    def test_evicted_version(self):
+        used = seats.version()
+        invalidate(1261)
+        self.assertEqual(seats.version(), used + 1)
+        # evicted by the cache, it doesn't start again from a used one
+        cache.delete(seats._version_key())
+        self.assertNotIn(seats.version(), (0, used, used + 1))
+
+
+class CacheSizeTests(AdditionalBaseTest):
+    "The shared cache doesn't evict entries at random on a real course"
+
+    def test_no_culling(self):
+        cache.set_many({"entry:%d" % i: i for i in range(1000)})
+        self.assertEqual(len(cache.get_many(["entry:%d" % i
+                                             for i in range(1000)])), 1000)
+
+
+class SeatCountsTests(AdditionalBaseTest):
+    "The free seats are polled, and answered without waiting"
+
+    def test_seat_counts(self):
+        self.user1.theoryGroup = TheoryGroup.objects.get(id=126)
+        self.user1.save()
+        lg = LabGroup.objects.get(id=1261)
+        lg.counter = lg.maxNumberStudents - 1
+        lg.save()
+        self.client.force_login(self.user1)
+        data = self.client.get(reverse("seatcounts")).json()
+        groups = {g["name"]: g for g in data["groups"]}
+        self.assertEqual(set(groups), {"1261", "1262", "1263"})
+        self.assertEqual(groups["1261"]["free"], 1)
+        self.assertFalse(groups["1261"]["open"])
+        self.assertTrue(groups["1262"]["open"])
+        # nothing changed since, so nothing is sent, without any query
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse("seatcounts"),
+                                       {"since": data["version"]})
+        self.assertEqual(response.status_code, 204)
+        LabGroup.objects.get(id=1262).add_student(self.user2)
+        response = self.client.get(reverse("seatcounts"),
+                                   {"since": data["version"]})
+        self.assertEqual(response.status_code, 200)
+        # the counts are only sent to the students
+        self.client.logout()
+        response = self.client.get(reverse("seatcounts"),
+                                   {"since": data["version"]})
+        self.assertEqual(response.status_code, 302)
+
+
+class WaitlistTests(AdditionalBaseTest):
+    "Students waiting for a full group get the freed seats"
+
+    def setUp(self):
+        super().setUp()
+        self.open_group_selection()
+        tg = TheoryGroup.objects.get(id=126)
+        for user in (self.user1, self.user2, self.user3):
+            user.theoryGroup = tg
+            user.save()
+        self.lg = LabGroup.objects.get(id=1261)
+        self.lg.counter = 0
+        self.lg.maxNumberStudents = 1
+        self.lg.save()
+        self.lg.add_student(self.user1)
+
+    def test_promotion(self):
+        self.client.force_login(self.user2)
+        response = self.client.post(reverse("applygroup"),
+                                    data={"labGroup": self.lg.id})
+        self.assertRegex(response.content.decode("utf-8"),
+                         r"You are number 1 in its waitlist")
+        self.assertEqual(WaitlistEntry.objects.count(), 1)
+
+        user1 = Student.objects.get(pk=self.user1.id)
+        LabGroup.objects.get(pk=self.lg.id).remove_student(user1)
+        self.assertEqual(Student.objects.get(pk=self.user2.id).labGroup_id,
+                         self.lg.id)
+        self.assertEqual(LabGroup.objects.get(pk=self.lg.id).counter, 1)
+        self.assertEqual(WaitlistEntry.objects.count(), 0)
+
+    def test_pair_promotion(self):
+        Pair(student1=self.user2, student2=self.user3, validated=True).save()
+        self.lg.join_waitlist(self.user2)
+        user1 = Student.objects.get(pk=self.user1.id)
+        self.lg.maxNumberStudents = 2
+        self.lg.save()
+        # one seat is not enough for the pair
+        self.assertEqual(Student.objects.filter(labGroup=self.lg).count(), 1)
+        LabGroup.objects.get(pk=self.lg.id).remove_student(user1)
+        self.assertEqual(Student.objects.filter(labGroup=self.lg).count(), 2)
+        self.assertEqual(LabGroup.objects.get(pk=self.lg.id).counter, 2)
+
+    def test_joined_elsewhere(self):
+        # user2 waits for lg, but then joins another group
+        self.lg.join_waitlist(self.user2)
+        other = LabGroup.objects.get(id=1262)
+        other.counter = 0
+        other.save()
+        self.assertTrue(other.add_students(self.user2))
+        self.assertEqual(WaitlistEntry.objects.count(), 0)
+        LabGroup.objects.get(pk=self.lg.id).remove_student(
+            Student.objects.get(pk=self.user1.id))
+        self.assertEqual(Student.objects.get(pk=self.user2.id).labGroup_id,
+                         other.id)
+
+    def test_promotion_stops_when_full(self):
+        self.lg.join_waitlist(self.user2)
+        self.lg.join_waitlist(self.user3)
+        self.bulk_students(20, TheoryGroup.objects.get(id=126))
+        for stu in Student.objects.filter(first_name="bulk"):
+            self.lg.join_waitlist(stu)
+        user1 = Student.objects.get(pk=self.user1.id)
+        # the seat goes to user2, the rest of the waitlist isn't read
+        with CaptureQueriesContext(connection) as queries:
+            LabGroup.objects.get(pk=self.lg.id).remove_student(user1)
+        self.assertLess(len(queries), 20)
+        self.assertEqual(Student.objects.get(pk=self.user2.id).labGroup_id,
+                         self.lg.id)
+        self.assertEqual(WaitlistEntry.objects.filter(labGroup=self.lg)
+                         .count(), 21)
+
+
+class LabGroupFormQueryTests(AdditionalBaseTest):
+    "The lab group form runs the same queries whatever the groups"
+
+    def test_constant_queries(self):
+        # 126 joins 3 lab groups, 120 only one
+        for tg in (126, 120):
+            self.user1.theoryGroup = TheoryGroup.objects.get(id=tg)
+            self.user1.save()
+            invalidate(*LabGroup.objects.values_list('id', flat=True))
+            with self.assertNumQueries(1):
+                str(LabGroupForm(self.user1))
+            with self.assertNumQueries(0):
+                str(LabGroupForm(self.user1))
+
+    def test_validation(self):
+        self.user1.theoryGroup = TheoryGroup.objects.get(id=126)
+        self.user1.save()
+        lg = LabGroup.objects.get(id=1262)
+        lg.counter = lg.maxNumberStudents - 1
+        lg.save()
+        form = LabGroupForm(self.user1, {"labGroup": 1261})
+        with self.assertNumQueries(1):
+            self.assertTrue(form.is_valid())
+        # full, or not allowed for the theory group
+        self.assertFalse(LabGroupForm(self.user1,
+                                      {"labGroup": 1262}).is_valid())
+        self.assertFalse(LabGroupForm(self.user1,
+                                      {"labGroup": 1291}).is_valid())
+
+
+class PairFormQueryTests(AdditionalBaseTest):
+    "The pair candidates are computed with a single query"
+
+    def setUp(self):
+        super().setUp()
+        tg = TheoryGroup.objects.get(id=126)
+        for user in (self.user1, self.user2, self.user3):
+            user.theoryGroup = tg
+            user.save()
+
+    def candidates(self):
+        with self.assertNumQueries(1):
+            return list(PairForm(self.user1).fields['student2'].queryset)
+
+    def test_candidates(self):
+        # user3 chose us, user2 is free
+        Pair(student1=self.user3, student2=self.user1).save()
+        self.assertEqual(self.candidates()[:2], [self.user3, self.user2])
+        # user2 chose somebody else
+        user4 = Student.objects.create_user(
+            id=FIRST_STUDENT_ID+3, username=USERNAME_4,
+            password=PASSWORD_4, first_name=FIRST_NAME_4,
+            last_name=LAST_NAME_4)
+        Pair(student1=self.user2, student2=user4).save()
+        self.assertNotIn(self.user2, self.candidates())
+
+    def render_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            str(PairForm(self.user1))
+        return len(queries)
+
+    def test_benchmark_10k_students(self):
+        # the queries don't grow with the students
+        self.bulk_students(100, self.user1.theoryGroup)
+        small = self.render_queries()
+        self.bulk_students(9900, self.user1.theoryGroup)
+        self.assertEqual(self.render_queries(), small)
+        self.assertEqual(len(self.candidates()), 10002)
+
+
+class ChoiceLabelQueryTests(AdditionalBaseTest):
+    "The choice labels don't load their related rows one by one"
+
+    def test_pair_form_labels(self):
+        tg = TheoryGroup.objects.get(id=126)
+        self.user1.theoryGroup = tg
+        self.user1.save()
+        self.bulk_students(300, tg)
+        Student.objects.filter(last_name__lt="00150")\
+            .update(labGroup=1261)
+        with self.assertNumQueries(1):
+            html = str(PairForm(self.user1))
+        self.assertEqual(html.count("(1261)>"), 150)
+        self.assertEqual(html.count("(%s)>" % tg), 150)
+
+    def test_break_pair_form_labels(self):
+        Pair(student1=self.user1, student2=self.user2).save()
+        with self.assertNumQueries(1):
+            html = str(BreakPairForm(self.user2))
+        self.assertEqual(html.count("%s | %s" % (self.user1, self.user2)),
+                         1)
+
+
+class EligibilityIndexTests(AdditionalBaseTest):
+    "The group constraints are read from an in-memory index"
+
+    def test_index(self):
+        self.assertEqual(sorted(eligibility.lab_groups(126)),
+                         [1261, 1262, 1263])
+        self.assertEqual(eligibility.theory_groups(1291), [129])
+        with self.assertNumQueries(0):
+            self.assertTrue(eligibility.can_join(126, 1261))
+            self.assertFalse(eligibility.can_join(126, 1291))
+        # rebuilt when the constraints change
+        gc = GroupConstraints.objects.get(labGroup=1291)
+        gc.theoryGroup = TheoryGroup.objects.get(id=126)
+        gc.save()
+        self.assertTrue(eligibility.can_join(126, 1291))
+        gc.delete()
+        self.assertFalse(eligibility.can_join(126, 1291))
+        TheoryGroup.objects.get(id=126).delete()
+        self.assertEqual(eligibility.lab_groups(126), [])
+
+    def test_version_check_ttl(self):
+        eligibility.lab_groups(126)
+        with mock.patch("core.eligibility.cache.get_or_set") as get_or_set:
+            for _ in range(100):
+                eligibility.lab_groups(126)
+            self.assertEqual(get_or_set.call_count, 0)
+        # another worker changes the constraints
+        GroupConstraints.objects.filter(labGroup=1291)\
+            .update(theoryGroup=126)
+        cache.set(eligibility._version_key(), "other", None)
+        self.assertFalse(eligibility.can_join(126, 1291))
+        later = time.monotonic() + settings.ELIGIBILITY_CHECK_TTL
+        with mock.patch("core.eligibility.time.monotonic",
+                        return_value=later):
+            self.assertTrue(eligibility.can_join(126, 1291))
+
+
+class LabGroupFormCacheTests(AdditionalBaseTest):
+    "The lab group forms are shared by the students with the same choices"
+
+    def test_groupchange_builds_few_forms(self):
+        self.bulk_students(100, TheoryGroup.objects.get(id=126))
+        self.bulk_students(100, TheoryGroup.objects.get(id=127))
+        admin = Student.objects.create_superuser("admin", "a@a.es", "admin")
+        self.client.force_login(admin)
+        with mock.patch("core.views.LabGroupForm",
+                        wraps=views.LabGroupForm) as form:
+            response = self.client.get(reverse("groupchange") +
+                                       "?all=1&expanded=1")
+            html = b"".join(response.streaming_content).decode("utf-8")
+            # 126, 127 and the students without a theory group
+            self.assertEqual(form.call_count, 3)
+            self.assertEqual(html.count('name="labGroup" required'), 203)
+            # the seats changed, the forms are built again
+            LabGroup.objects.get(id=1261).add_student(self.user1)
+            response = self.client.get(reverse("groupchange") + "?all=1")
+            b"".join(response.streaming_content)
+            self.assertEqual(form.call_count, 6)
+
+    def test_lru(self):
+        with mock.patch("core.views.LAB_GROUP_FORM_CACHE_SIZE", 2):
+            for tg in (126, 127, 129):
+                self.user1.theoryGroup_id = tg
+                views.lab_group_form(self.user1, 1)
+            self.assertEqual(len(views.LAB_GROUP_FORM_CACHE), 2)
+            self.assertEqual([k[0] for k in views.LAB_GROUP_FORM_CACHE],
+                             [127, 129])
+
+
+class ApplyGroupFragmentTests(AdditionalBaseTest):
+    "The groups of applygroup are a cached page fragment"
+
+    def test_fragment(self):
+        self.user1.theoryGroup = TheoryGroup.objects.get(id=126)
+        self.user1.save()
+        self.user2.theoryGroup = TheoryGroup.objects.get(id=126)
+        self.user2.save()
+        self.open_group_selection()
+        with mock.patch("core.views.lab_group_form",
+                        wraps=views.lab_group_form) as form:
+            self.client.force_login(self.user1)
+            first = self.client.get(reverse("applygroup"))
+            self.assertEqual(form.call_count, 1)
+            # same theory group, the fragment is reused
+            self.client.force_login(self.user2)
+            second = self.client.get(reverse("applygroup"))
+            self.assertEqual(form.call_count, 1)
+            self.assertIn('value="1261"', second.content.decode("utf-8"))
+            self.assertNotEqual(first.context["csrf_token"],
+                                second.context["csrf_token"])
+            # the seats changed, the fragment is rendered again
+            LabGroup.objects.get(id=1262).add_student(self.user3)
+            self.client.get(reverse("applygroup"))
+            self.assertEqual(form.call_count, 2)
+
+
+class GroupChangePageTests(AdditionalBaseTest):
+    "The group change page is paginated, or streamed"
+
+    def setUp(self):
+        super().setUp()
+        self.bulk_students(250, TheoryGroup.objects.get(id=126))
+        Pair(student1=self.user1, student2=self.user2,
+             validated=True).save()
+        admin = Student.objects.create_superuser("admin", "a@a.es", "admin")
+        self.client.force_login(admin)
+
+    def test_keyset_pages(self):
+        # the same names again, so the pages also split between them
+        self.bulk_students(50, TheoryGroup.objects.get(id=126))
+        keys = []
+        url = reverse("groupchange")
+        while url:
+            response = self.client.get(url)
+            keys += [(row.last_name, row.first_name, row.id)
+                     for row, form, choices in response.context["students"]]
+            nxt = response.context.get("next")
+            url = nxt and reverse("groupchange") + "?after=%d" % nxt
+        self.assertEqual(len(keys), 303)
+        self.assertEqual(keys, sorted(set(keys)))
+
+    def test_queries_dont_depend_on_page_size(self):
+        self.client.get(reverse("groupchange"))
+        for size in (10, 200):
+            with self.settings(GROUPCHANGE_PAGE_SIZE=size):
+                # session, user, the page of students, and the groups
+                # of the search form
+                with self.assertNumQueries(5):
+                    response = self.client.get(reverse("groupchange"))
+                self.assertEqual(len(response.context["students"]), size)
+        # the pair needs the groups with 2 free seats
+        with self.settings(GROUPCHANGE_PAGE_SIZE=300):
+            response = self.client.get(reverse("groupchange"))
+        row, form, choices = next(s for s in response.context["students"]
+                                  if s[0].id == self.user1.id)
+        self.assertTrue(row.partnered)
+        self.assertEqual(form, views.lab_group_form(self.user1, 2))
+
+    def test_stream(self):
+        response = self.client.get(reverse("groupchange") + "?all=1")
+        content = response.streaming_content
+        first = next(content).decode("utf-8")
+        self.assertIn("Group change page", first)
+        self.assertNotIn('name="student"', first)
+        html = first + b"".join(content).decode("utf-8")
+        self.assertEqual(html.count('name="student"'), 253)
+        self.assertEqual(html.count('csrfmiddlewaretoken'), 253)
+        self.assertTrue(html.rstrip().endswith("</html>"))
+
+    def test_choices_sent_once(self):
+        self.bulk_students(50, TheoryGroup.objects.get(id=127))
+        url = reverse("groupchange") + "?all=1"
+        expanded = b"".join(self.client.get(url + "&expanded=1")
+                            .streaming_content).decode("utf-8")
+        html = b"".join(self.client.get(url).streaming_content)\
+            .decode("utf-8")
+        # 126, 127, and without theory group alone and in pair
+        select = '<select name="labGroup" required'
+        self.assertEqual(html.count(select), 4)
+        self.assertEqual(expanded.count(select), 303)
+        self.assertLess(len(html), len(expanded))
+        used = set(re.findall(r'data-choices="([^"]+)"', html))
+        sent = re.findall(r'id="choices-([^"]+)"', html)
+        self.assertEqual(sorted(used), sorted(sent))
+        # each one is sent before the first row that uses it
+        for choices in sent:
+            self.assertLess(html.index('id="choices-%s"' % choices),
+                            html.index('data-choices="%s"' % choices))
+        # the paginated page does the same
+        response = self.client.get(reverse("groupchange"))
+        self.assertEqual([c for c, form in response.context["choice_sets"]],
+                         ["126-1", "127-1"])
+
+
+class GroupChangeSearchTests(AdditionalBaseTest):
+    "The students of the group change page can be filtered"
+
+    def setUp(self):
+        super().setUp()
+        self.bulk_students(150, TheoryGroup.objects.get(id=126))
+        self.bulk_students(50, TheoryGroup.objects.get(id=127))
+        admin = Student.objects.create_superuser("admin", "a@a.es", "admin")
+        self.client.force_login(admin)
+
+    @override_settings(GROUPCHANGE_PAGE_SIZE=500)
+    def search(self, **filters):
+        response = self.client.get(reverse("groupchange"), filters)
+        return [row.id for row, form, choices in response.context["students"]]
+
+    def test_filters(self):
+        student = Student.objects.filter(theoryGroup=126)\
+            .order_by("id")[10]
+        LabGroup.objects.get(id=1262).add_student(student)
+        self.assertEqual(len(self.search(theoryGroup=127)), 50)
+        self.assertEqual(self.search(labGroup=1262), [student.id])
+        self.assertEqual(len(self.search(labGroup="none")), 202)
+        self.assertEqual(len(self.search(theoryGroup=126, labGroup="none")),
+                         149)
+        self.assertEqual(self.search(username=student.username),
+                         [student.id])
+        # the prefix of the bulk last names (00000, 00001, ...) of both
+        self.assertEqual(len(self.search(last_name="0001")), 20)
+        self.assertEqual(self.search(last_name="Nobody"), [])
+        # in any case
+        self.user1.last_name = "del Val"
+        self.user1.save()
+        self.assertEqual(self.search(last_name="Del v"), [self.user1.id])
+        self.assertEqual(self.search(last_name="DEL VAL"), [self.user1.id])
+        # the filters are kept in the next page, and in the page the
+        # group changes are sent from
+        response = self.client.get(reverse("groupchange"),
+                                   {"theoryGroup": 126, "after": student.id})
+        html = response.content.decode("utf-8")
+        self.assertIn("theoryGroup=126&after=", html)
+        self.assertIn('action="%s?theoryGroup=126&amp;after=%d"' %
+                      (reverse("groupchange"), student.id), html)
+
+    def test_indexes(self):
+        with connection.cursor() as cursor:
+            indexes = connection.introspection.get_constraints(
+                cursor, "auth_user")
+            self.assertIn("core_user_last_name_upper_idx", indexes)
+            indexes = connection.introspection.get_constraints(
+                cursor, "core_student")
+            self.assertIn("core_student_groups_idx", indexes)
+
+
+class ReassignGroupsTests(AdditionalBaseTest):
+    "Many students are moved at once from a csv file"
+
+    def setUp(self):
+        super().setUp()
+        self.bulk_students(30, TheoryGroup.objects.get(id=126))
+        self.students = list(Student.objects.filter(theoryGroup=126)
+                             .order_by("id"))
+        for s in self.students[:3]:
+            LabGroup.objects.get(id=1261).add_student(s)
+
+    def reassign(self, moves, *args, out=None):
+        with tempfile.NamedTemporaryFile("w", suffix=".csv") as f:
+            f.write("NIE,grupo-practicas\n")
+            for stu, group in moves:
+                f.write("%s,%s\n" % (stu.username, group))
+            f.flush()
+            out = out or StringIO()
+            call_command("reassigngroups", f.name, *args, stdout=out,
+                         stderr=out)
+        return out.getvalue()
+
+    def test_moves(self):
+        moved = self.students[:20]
+        out = self.reassign([(s, 1262) for s in moved], "--dry-run")
+        self.assertIn("Students moved: 20", out)
+        self.assertEqual(LabGroup.objects.get(id=1262).counter, 0)
+        self.reassign([(s, 1262) for s in moved])
+        self.assertEqual(LabGroup.objects.get(id=1261).counter, 0)
+        self.assertEqual(LabGroup.objects.get(id=1262).counter, 20)
+        self.assertEqual(Student.objects.filter(labGroup=1262).count(), 20)
+
+    def test_pair_moves_together(self):
+        self.user1.theoryGroup = self.user2.theoryGroup =\
+            TheoryGroup.objects.get(id=126)
+        self.user1.save()
+        self.user2.save()
+        Pair(student1=self.user1, student2=self.user2,
+             validated=True).save()
+        self.reassign([(self.user1, 1263)])
+        self.assertEqual(Student.objects.get(id=self.user2.id).labGroup_id,
+                         1263)
+        self.assertEqual(LabGroup.objects.get(id=1263).counter, 2)
+
+    def test_all_or_nothing(self):
+        moves = [(s, 1262) for s in self.students[:24]] +\
+            [(self.students[25], 1291)]
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            self.reassign(moves, out=out)
+        self.assertIn("can't join", out.getvalue())
+        self.assertIn("would have 24 students", out.getvalue())
+        self.assertEqual(LabGroup.objects.get(id=1262).counter, 0)
+        self.assertEqual(Student.objects.filter(labGroup=1262).count(), 0)
+        self.assertEqual(LabGroup.objects.get(id=1261).counter, 3)
+
+
+class StudentBackendTests(AdditionalBaseTest):
+    "request.user is the student, loaded with his groups"
+
+    def setUp(self):
+        super().setUp()
+        self.user1.theoryGroup = TheoryGroup.objects.get(id=126)
+        self.user1.save()
+        LabGroup.objects.get(id=1261).add_student(self.user1)
+
+    def home_queries(self):
+        self.client.force_login(self.user1)
+        # not the cached summary
+        dashboard.invalidate(self.user1.id)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("home"))
+        self.assertContains(response, "1261")
+        return response.wsgi_request.user, len(queries)
+
+    def test_request_user(self):
+        user, queries = self.home_queries()
+        self.assertIsInstance(user, Student)
+        self.assertIs(Student.from_user(user), user)
+        with self.assertNumQueries(0):
+            str(user.labGroup.teacher)
+            str(user.theoryGroup)
+        with self.settings(AUTHENTICATION_BACKENDS=[
+                "django.contrib.auth.backends.ModelBackend"]):
+            user, default = self.home_queries()
+        self.assertNotIsInstance(user, Student)
+        self.assertLessEqual(queries, default - 2)
+
+    def test_superuser(self):
+        admin = User.objects.create_superuser("admin", "a@a.es", "admin")
+        self.client.force_login(admin)
+        response = self.client.get(reverse("home"))
+        self.assertEqual(response.wsgi_request.user, admin)
+
+
+class OtherConstraintsCacheTests(AdditionalBaseTest):
+    "The constraints are cached on the process"
+
+    def test_cached(self):
+        oc = OtherConstraints.get()
+        with self.assertNumQueries(0):
+            self.assertIs(OtherConstraints.get(), oc)
+            self.assertEqual(OtherConstraints.group_selection(),
+                             OtherConstraints.CLOSED)
+        # saving them drops the cache
+        self.open_group_selection()
+        with self.assertNumQueries(1):
+            self.assertEqual(OtherConstraints.group_selection(),
+                             OtherConstraints.OPEN)
+        oc = OtherConstraints.get()
+        oc.preferenceEndDate = timezone.now() + datetime.timedelta(days=1)
+        oc.save()
+        self.assertEqual(OtherConstraints.group_selection(),
+                         OtherConstraints.PREFERENCES)
+        self.assertEqual(OtherConstraints.group_selection(
+            oc.preferenceEndDate), OtherConstraints.OPEN)
+        oc.delete()
+        self.assertIsNone(OtherConstraints.get())
+        self.assertEqual(OtherConstraints.group_selection(),
+                         OtherConstraints.OPEN)
+
+    def test_ttl(self):
+        OtherConstraints.get()
+        # changed without signals, as another worker would
+        OtherConstraints.objects.update(minGradeLabConv=9)
+        self.assertNotEqual(OtherConstraints.get().minGradeLabConv, 9)
+        with mock.patch("core.models.time.monotonic",
+                        return_value=time.monotonic() + 61):
+            self.assertEqual(OtherConstraints.get().minGradeLabConv, 9)
+
+    def test_applygroup_closed(self):
+        self.client.force_login(self.user1)
+        self.client.get(reverse("applygroup"))
+        # session and user (with his groups)
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse("applygroup"))
+        self.assertTrue(response.context["not_active"])
+
+
+class HomeDashboardTests(AdditionalBaseTest):
+    "The home page of a student is two queries, and then cached"
+
+    def setUp(self):
+        super().setUp()
+        self.user1.theoryGroup = TheoryGroup.objects.get(id=126)
+        self.user1.save()
+        Pair(student1=self.user2, student2=self.user1).save()
+        Pair(student1=self.user3, student2=self.user1).save()
+        self.client.force_login(self.user1)
+
+    def home(self):
+        return self.client.get(reverse("home")).content.decode("utf-8")
+
+    def test_queries(self):
+        # session, the student with his groups, and his pairs
+        with self.assertNumQueries(3):
+            html = self.home()
+        self.assertIn("%s</b> wants to be your partner" % self.user2, html)
+        self.assertIn("%s</b> wants to be your partner" % self.user3, html)
+        # cached, the pairs aren't read again
+        with self.assertNumQueries(2):
+            self.assertEqual(self.home(), html)
+
+    def test_invalidation(self):
+        self.home()
+        # a new group is seen, without any invalidation
+        LabGroup.objects.get(id=1261).add_student(self.user1)
+        self.assertIn("Your laboratory group is <b>1261", self.home())
+        # a pair is validated
+        Pair(student1=self.user1, student2=self.user2).save()
+        html = self.home()
+        self.assertIn("You're part of the following pair", html)
+        self.assertNotIn("wants to be your partner", html)
+        # and broken
+        Pair.objects.get(student1=self.user2).delete()
+        self.assertIn("You are NOT part of any pair", self.home())
+
+    def test_evicted_version(self):
+        cache.delete(dashboard._key(self.user1.id))
+        self.assertIn("You are NOT part of any pair", self.home())
+        Pair(student1=self.user1, student2=self.user2).save()
+        self.assertIn("You're part of the following pair", self.home())
+        # evicted by the cache, it doesn't go back to the first fragment
+        cache.delete(dashboard._key(self.user1.id))
+        self.assertIn("You're part of the following pair", self.home())
+
+
+class ConvalidationTests(AdditionalBaseTest):
+    "The convalidation is only written when it changes"
+
+    def setUp(self):
+        super().setUp()
+        Student.objects.filter(id__in=[self.user1.id, self.user2.id,
+                                       self.user3.id])\
+            .update(gradeLabLastYear=9, gradeTheoryLastYear=9)
+
+    def writes(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("convalidation"))
+        return response, [q["sql"] for q in queries
+                          if q["sql"].startswith("UPDATE")]
+
+    def test_view_writes_changes(self):
+        self.client.force_login(self.user1)
+        response, writes = self.writes()
+        self.assertTrue(response.context["convalidated"])
+        self.assertEqual(len(writes), 1)
+        self.assertIn('"convalidationGranted"', writes[0])
+        self.assertNotIn('"gradeLabLastYear"', writes[0])
+        response, writes = self.writes()
+        self.assertTrue(response.context["convalidated"])
+        self.assertEqual(writes, [])
+
+    def test_command(self):
+        self.bulk_students(1000, TheoryGroup.objects.get(id=126))
+        Student.objects.filter(last_name__startswith="001")\
+            .update(gradeLabLastYear=8, gradeTheoryLastYear=5)
+        Student.objects.filter(last_name__startswith="0010")\
+            .update(convalidationGranted=True, gradeTheoryLastYear=2)
+        LabGroup.objects.get(id=1261).add_student(self.user3)
+        Pair(student1=self.user1, student2=self.user2).save()
+        out = StringIO()
+        call_command("convalidate", stdout=out)
+        granted = set(Student.objects.filter(convalidationGranted=True)
+                      .values_list("id", flat=True))
+        # user2 only requested, user1 asked for the pair
+        self.assertIn(self.user2.id, granted)
+        self.assertNotIn(self.user1.id, granted)
+        self.assertNotIn(self.user3.id, granted)
+        self.assertEqual(len(granted), 91)
+        self.assertIn("granted: 91", out.getvalue())
+        self.assertIn("revoked: 10", out.getvalue())
+        # the page agrees
+        for stu in (self.user1, self.user2, self.user3):
+            self.client.force_login(stu)
+            response, writes = self.writes()
+            self.assertEqual(response.context["convalidated"],
+                             stu.id in granted)
+            self.assertEqual(writes, [])
+
+
+class ConvalidationWhatIfTests(AdditionalBaseTest):
+    "Convalidation counts for a grid of minimum grades"
+
+    def test_threshold_counts(self):
+        rnd = random.Random(3)
+        grades = [(rnd.randint(0, 20) / 2, rnd.randint(0, 20) / 2)
+                  for _ in range(500)]
+        theory = [i / 2 for i in range(21)]
+        lab = [1, 3.5, 7, 9.5]
+        counts = threshold_counts(grades, theory, lab)
+        for i, t in enumerate(theory):
+            for j, lb in enumerate(lab):
+                self.assertEqual(counts[i][j],
+                                 sum(1 for g in grades
+                                     if g[0] > t and g[1] > lb))
+
+    def test_large_course(self):
+        rnd = random.Random(5)
+        grades = [(rnd.random() * 10, rnd.random() * 10)
+                  for _ in range(100000)]
+        grid = [i / 4 for i in range(41)]
+        start = time.perf_counter()
+        counts = threshold_counts(grades, grid, grid)
+        elapsed = time.perf_counter() - start
+        self.assertEqual(counts[0][0], sum(1 for t, lb in grades
+                                           if t > 0 and lb > 0))
+        self.assertLess(elapsed, 1)
+
+    def test_command(self):
+        Student.objects.filter(id=self.user1.id)\
+            .update(gradeTheoryLastYear=5, gradeLabLastYear=8)
+        Student.objects.filter(id=self.user2.id)\
+            .update(gradeTheoryLastYear=2, gradeLabLastYear=8,
+                    theoryGroup=126)
+        out = StringIO()
+        call_command("convalidationwhatif", "--theory", "3:5:1",
+                     "--lab", "7:7:1", "--by-group", stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], "All the students (3)")
+        self.assertEqual([line.split() for line in lines[2:5]],
+                         [["3.0", "1"], ["4.0", "1"], ["5.0", "0"]])
+        self.assertIn("Theory group 126 (1)", lines)
+
+
+class PairSaveTests(AdditionalBaseTest):
+    "Pair.save is atomic, and the database rejects repeated pairs"
+
+    def test_crossed_requests(self):
+        # savepoint, lock, pairs, insert, partners and release
+        with self.assertNumQueries(6):
+            self.assertEqual(Pair(student1=self.user1,
+                                  student2=self.user2).save(), Pair.OK)
+        # the answer validates the first request, without a new row
+        with self.assertNumQueries(6):
+            self.assertEqual(Pair(student1=self.user2,
+                                  student2=self.user1).save(), Pair.OK)
+        pair = Pair.objects.get()
+        self.assertTrue(pair.validated)
+        self.assertEqual(pair.members, "%d-%d" % (self.user1.id,
+                                                  self.user2.id))
+        self.assertEqual(Pair(student1=self.user3,
+                              student2=self.user1).save(),
+                         Pair.SECOND_HAS_PAIR)
+
+    def test_return_codes(self):
+        Pair(student1=self.user1, student2=self.user2).save()
+        self.assertEqual(Pair(student1=self.user1,
+                              student2=self.user3).save(),
+                         Pair.YOU_HAVE_PAIR)
+        self.assertEqual(Pair(student1=self.user3,
+                              student2=self.user1).save(),
+                         Pair.SECOND_HAS_PAIR)
+        self.assertEqual(Pair.objects.count(), 1)
+
+    def test_unordered_uniqueness(self):
+        Pair(student1=self.user1, student2=self.user2).save()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            # as a concurrent request would, without seeing the first one
+            Pair.objects.bulk_create([
+                Pair(student1=self.user2, student2=self.user1,
+                     members="%d-%d" % (self.user1.id, self.user2.id))])
+
+    def test_migration_merges_repeated_pairs(self):
+        # two crossed requests saved before the members existed
+        Pair.objects.bulk_create([
+            Pair(student1=self.user1, student2=self.user2),
+            Pair(student1=self.user2, student2=self.user1)])
+        migration = importlib.import_module(
+            "core.migrations.0005_pair_members")
+        migration.fill_members(django_apps, None)
+        pair = Pair.objects.get()
+        self.assertEqual(pair.student1_id, self.user1.id)
+        self.assertTrue(pair.validated)
+        self.assertEqual(pair.members, "%d-%d" % (self.user1.id,
+                                                  self.user2.id))
+        # so it can be saved again
+        pair.break_pair(self.user1)
+        self.assertFalse(Pair.objects.get().validated)
+
+
+class PartnerTests(AdditionalBaseTest):
+    "The pair of a student comes with him"
+
+    def state(self, stu):
+        stu = Student.objects.get(id=stu.id)
+        return stu.partner_id, stu.pairState
+
+    def test_partner(self):
+        Pair(student1=self.user1, student2=self.user2).save()
+        self.assertEqual(self.state(self.user1),
+                         (self.user2.id, Student.PAIR_REQUESTED))
+        self.assertEqual(self.state(self.user2), (None, Student.NO_PAIR))
+        Pair(student1=self.user2, student2=self.user1).save()
+        self.assertEqual(self.state(self.user1),
+                         (self.user2.id, Student.PAIR_VALIDATED))
+        self.assertEqual(self.state(self.user2),
+                         (self.user1.id, Student.PAIR_VALIDATED))
+        # an outdated instance doesn't undo it
+        self.user2.first_name = "changed"
+        self.user2.save()
+        self.assertEqual(self.state(self.user2),
+                         (self.user1.id, Student.PAIR_VALIDATED))
+        # broken by user2, user1 keeps his request
+        pair = Pair.objects.get()
+        pair.break_pair(self.user2)
+        self.assertEqual(self.state(self.user1),
+                         (self.user2.id, Student.PAIR_REQUESTED))
+        self.assertEqual(self.state(self.user2), (None, Student.NO_PAIR))
+        pair.delete()
+        self.assertEqual(self.state(self.user1), (None, Student.NO_PAIR))
+
+    def test_same_as_get_pair(self):
+        Pair(student1=self.user1, student2=self.user2).save()
+        Pair(student1=self.user3, student2=self.user2).save()
+        for stu in Student.objects.all():
+            pair = Pair.get_pair(stu)
+            if pair is None:
+                self.assertEqual(stu.pairState, Student.NO_PAIR)
+            else:
+                self.assertEqual(stu.partner_id, pair.student2_id
+                                 if pair.student1_id == stu.id
+                                 else pair.student1_id)
+
+
+class LookupIndexTests(AdditionalBaseTest):
+    "The hot lookups use their indexes"
+
+    def plan(self, queryset):
+        if connection.vendor == 'postgresql':
+            # With a few rows a sequential scan is always cheaper
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+        return queryset.explain()
+
+    def test_indexes(self):
+        tg = TheoryGroup.objects.first()
+        self.bulk_students(50, tg)
+        stu = self.user1
+        search = StudentSearchForm({'theoryGroup': tg.id, 'labGroup': 'none'})
+        self.assertTrue(search.is_valid())
+        lookups = [
+            # Pair.get_pair
+            (Pair.objects.filter(Q(student1=stu) |
+                                 (Q(student2=stu) & Q(validated=True))),
+             'core_pair_student2_idx'),
+            # LabGroupForm
+            (LabGroup.with_space(tg.id), 'core_constraint_groups_idx'),
+            # PairForm
+            (PairForm(stu).fields['student2'].queryset,
+             'core_student_groups_idx'),
+            # the group change page, sorted by name and filtered by groups
+            (views.groupchange_rows(
+                Student.objects.exclude(is_superuser=True))[:100],
+             'core_user_name_idx'),
+            (views.groupchange_rows(search.filter(
+                Student.objects.exclude(is_superuser=True)))[:100],
+             'core_student_groups_idx'),
+        ]
+        for queryset, index in lookups:
+            self.assertIn(index, self.plan(queryset))
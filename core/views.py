@@ -1,19 +1,64 @@
 from django.shortcuts import render, redirect
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.template.loader import get_template, render_to_string
+from django.middleware.csrf import get_token
+from django.conf import settings
+from django.db.models import Q, Case, When, Value, BooleanField
 from django.urls import reverse
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required, user_passes_test
-from django.utils import timezone
-from core.forms import LabGroupForm, PairForm, LoginForm, BreakPairForm
+from django.utils.functional import SimpleLazyObject
+from core.forms import (LabGroupForm, PairForm, LoginForm, BreakPairForm,
+                        GroupPreferenceForm, StudentSearchForm)
+from core.admission import admission_required
+from core import seats, eligibility, dashboard
 from core.models import (Student, Pair, OtherConstraints,
-                         LabGroup, GroupConstraints)
-import datetime
+                         LabGroup, GroupPreference)
+from collections import OrderedDict, namedtuple
+import threading
 
 OK_GROUP_JOINED = 0
 ERROR_GROUP_CANT_JOIN = 1
 ERROR_GROUP_FULL_PARTNER = 2
 ERROR_GROUP_FULL = 3
 
-LAB_GROUP_FORM_CACHE = {}
+# The LabGroupForm only depends on the theory group, on how many students
+# join and on the seats and constraints, so it's shared by every student
+# with the same ones. It's a bounded LRU cache, on each process.
+LAB_GROUP_FORM_CACHE = OrderedDict()
+LAB_GROUP_FORM_CACHE_SIZE = 64
+LAB_GROUP_FORM_CACHE_LOCK = threading.Lock()
+
+
+def lab_group_form(stu, joining=None):
+    """Gets the (unbound) LabGroupForm of a student from
+    `LAB_GROUP_FORM_CACHE`, or builds it if it's not there.
+
+    :param stu: The student who will join a group
+    :type stu: core.models.Student
+    :param joining: How many students will join (2 if he has a validated
+    pair), computed if it's not given
+    :type joining: int
+    :return: The form with the groups he can join
+    :rtype: core.forms.LabGroupForm
+    """
+    if joining is None:
+        joining = 2 if stu.pairState == Student.PAIR_VALIDATED else 1
+    # The versions change with any seat count or constraint, so the
+    # outdated forms are never used again and end up evicted
+    key = (stu.theoryGroup_id, joining, seats.version(),
+           eligibility.version())
+    with LAB_GROUP_FORM_CACHE_LOCK:
+        form = LAB_GROUP_FORM_CACHE.get(key)
+        if form is not None:
+            LAB_GROUP_FORM_CACHE.move_to_end(key)
+            return form
+    form = LabGroupForm(stu, joining=joining)
+    with LAB_GROUP_FORM_CACHE_LOCK:
+        LAB_GROUP_FORM_CACHE[key] = form
+        while len(LAB_GROUP_FORM_CACHE) > LAB_GROUP_FORM_CACHE_SIZE:
+            LAB_GROUP_FORM_CACHE.popitem(last=False)
+    return form
 
 
 def home(request):
@@ -32,13 +77,12 @@ def home(request):
     """
     context_dict = {}
     if request.user.is_authenticated and not request.user.is_superuser:
+        # The student comes with his groups, and the pairs are only read
+        # if his cached summary (see home.html) is missing or outdated
         stu = Student.from_user(request.user)
         context_dict['student'] = stu
-        pair = Pair.get_pair(stu)
-        if pair:
-            context_dict['pair'] = pair
-        else:
-            context_dict['pairs'] = Pair.objects.filter(student2=stu)
+        context_dict['pairs'] = SimpleLazyObject(lambda: home_pairs(stu))
+        context_dict['pairs_version'] = dashboard.version(stu.id)
     if 'home_msg' in request.session:
         context_dict['msg'] = request.session['home_msg'][0]
         context_dict['isError'] = request.session['home_msg'][1]
@@ -46,6 +90,26 @@ def home(request):
     return render(request, 'core/home.html', context_dict)
 
 
+def home_pairs(stu):
+    """Gets the pair of a student and the pairs other students requested
+    him, with the names of everyone, in a single query
+
+    :param stu: The student
+    :type stu: core.models.Student
+    :return: ``{'pair': his pair or None, 'requests': [requested pairs]}``,
+    as in :meth:`core.models.Pair.get_pair`
+    :rtype: dict
+    """
+    pairs = {'pair': None, 'requests': []}
+    for p in Pair.objects.filter(Q(student1=stu) | Q(student2=stu))\
+            .select_related('student1', 'student2').order_by('id'):
+        if p.student1_id == stu.id or p.validated:
+            pairs['pair'] = p
+        else:
+            pairs['requests'].append(p)
+    return pairs
+
+
 def student_login(request):
     """
     The login page, rendered only if you're not logged in.
@@ -135,7 +199,7 @@ def convalidation(request):
     :rtype: django.http.HttpResponse
     """
     context_dict = {}
-    oc = OtherConstraints.objects.first()
+    oc = OtherConstraints.get()
     stu = Student.from_user(request.user)
 
     # add the grade variables, used to print
@@ -147,26 +211,29 @@ def convalidation(request):
     # update the convalidation variable if he meets the basic
     # conditions: grades higher than constraints,
     # and the user didn't select a group
-    stu.convalidationGranted = stu.gradeLabLastYear > oc.minGradeLabConv\
+    # (the same rules as manage.py convalidate, for everyone at once)
+    granted = stu.gradeLabLastYear > oc.minGradeLabConv\
         and stu.gradeTheoryLastYear > oc.minGradeTheoryConv
-    if not stu.convalidationGranted:
+    if not granted:
         context_dict['why_not_conv'] = "Your last year grades don't meet " + \
             "the requirements!"
     elif stu.labGroup is not None:
         context_dict['why_not_conv'] = "You're already in a group!"
-        stu.convalidationGranted = False
+        granted = False
 
-    if stu.convalidationGranted:
+    if granted:
         # do not convalidate if user has a validated pair
         # or they are the first member of their pair
-        p = Pair.get_pair(stu)
-        if p is not None:
-            if p.validated or p.student1 == stu:
-                context_dict['why_not_conv'] = "You're in a validated " + \
-                    "pair, or you requested a pair!"
-                stu.convalidationGranted = False
-
-    stu.save()
+        if stu.pairState != Student.NO_PAIR:
+            context_dict['why_not_conv'] = "You're in a validated " + \
+                "pair, or you requested a pair!"
+            granted = False
+
+    # Only write the flag if it changed, and nothing else of the student
+    if stu.convalidationGranted != granted:
+        stu.convalidationGranted = granted
+        Student.objects.filter(id=stu.id)\
+            .update(convalidationGranted=granted)
     context_dict['convalidated'] = stu.convalidationGranted
 
     return render(request, 'core/convalidation.html', context_dict)
@@ -242,7 +309,7 @@ def applypair(request):
     # GET, or else a "continue" from our POST method
     # 'pair' is our previously defined variable, try fetching
     # it if it's a None object
-    if not pair:
+    if not pair and s.pairState != Student.NO_PAIR:
         pair = Pair.get_pair(s)
     # If there's a pair, render it properly
     if pair:
@@ -257,60 +324,33 @@ def change_students_group(stu, lg, context_dict):
     # user to this group.
 
     # Get the constraints for this group, if there's any
-    canJoin = GroupConstraints.objects.filter(
-        theoryGroup=stu.theoryGroup,
-        labGroup=lg).exists()
+    canJoin = eligibility.can_join(stu.theoryGroup_id, lg.id)
     if canJoin is False:
         context_dict['msg'] = ""
         context_dict['isError'] = True
         # Render the groups, since there's been an error
-        context_dict['groups'] = LabGroupForm(stu)
+        context_dict['groups'] = lab_group_form(stu)
         return ERROR_GROUP_CANT_JOIN
 
     # Check if his pair *can* be with him too
-    pair = Pair.get_pair(stu)
-    joinWithPair = False
-    if pair:
-        joinWithPair = pair.validated
-    if joinWithPair:
-        fren = pair.student2 if stu == pair.student1\
-            else pair.student1
-        skipCounterCheck = False
-        # First, check if our student is in another group
-        if fren.labGroup:
-            if fren.labGroup == lg:
-                # mark this as true if he's inside
-                # our Lab Group already
-                skipCounterCheck = True
-
-        # Second, check if there's enough space
-        if not skipCounterCheck and lg.counter + 2 > lg.maxNumberStudents\
-                and fren.labGroup:
+    if stu.pairState == Student.PAIR_VALIDATED:
+        fren = stu.partner
+        # Both seats are reserved in a single transaction, so the
+        # pair is never split and the counters never drift
+        if not lg.add_students(stu, fren):
             # They can't join this group...
             # to avoid weird errors, just disallow both
             return ERROR_GROUP_FULL_PARTNER
-        # Thirdly, if there is space and he's not on our group,
-        # add him without an error
-        if not skipCounterCheck and fren.labGroup:
-            # But first, remove it from his group if it's not
-            # out desired group
-            if fren.labGroup != lg:
-                # Change groups
-                fren.labGroup.remove_student(fren)
-        # Finally, add it to his new group.
-        lg.add_student(fren)
-
-    # If our student had a group, remove
-    # it from the old group
-    if stu.labGroup:
-        stu.labGroup.remove_student(stu)
-    # Assign the group and give him a nice message
-    added = lg.add_student(stu)
+        return
+
+    # Assign the group (releasing the old one, if any)
+    added = lg.add_students(stu)
     if not added:
         return ERROR_GROUP_FULL
 
 
 @login_required
+@admission_required
 def applygroup(request):
     """
     The Apply Group page.
@@ -324,6 +364,11 @@ def applygroup(request):
        :class:`core.models.GroupConstraints`
        that reference your :class:`core.models.TheoryGroup`
 
+    .. note::
+       `POST` requests go through :meth:`core.admission.admission_required`,
+       which sends the students to a waiting room when there are already
+       too many seat requests being processed.
+
     :param request: The user's HttpRequest object, which contains data about
     the user
     :type request: django.http.HttpRequest
@@ -335,14 +380,22 @@ def applygroup(request):
 
     # The student already has a lab group
     # No need to compute the groups
-    try:
-        now = datetime.datetime.now()
-        now = timezone.make_aware(now, timezone.get_current_timezone())
-        if OtherConstraints.objects.first().selectGroupStartDate > now:
-            context_dict['not_active'] = True
-            return render(request, 'core/applygroup.html', context_dict)
-    except OtherConstraints.DoesNotExist:
-        pass
+    selection = OtherConstraints.group_selection()
+    if selection == OtherConstraints.CLOSED:
+        context_dict['not_active'] = True
+        return render(request, 'core/applygroup.html', context_dict)
+    # During the preference window the groups are ranked, not joined, and
+    # the students who already have one can't change it, so nobody takes
+    # the free seats before the groups are assigned
+    if selection == OtherConstraints.PREFERENCES:
+        if stu.labGroup_id is None:
+            return rank_groups(request, stu, context_dict)
+        context_dict['group'] = stu.labGroup
+        if request.method == 'POST':
+            context_dict['msg'] = "Groups can't be changed until " +\
+                "they are assigned to everyone."
+            context_dict['isError'] = True
+        return render(request, 'core/applygroup.html', context_dict)
     # The student selects a lab group
     if request.method == 'POST':
         try:
@@ -367,18 +420,123 @@ def applygroup(request):
             if message in message_switch:
                 context_dict['msg'] = message_switch[message]
                 context_dict['isError'] = True
+            # Wait for a seat instead of retrying (the waitlists are only
+            # for the students without a group, see promote_waitlists)
+            if message in (ERROR_GROUP_FULL, ERROR_GROUP_FULL_PARTNER) and\
+                    stu.labGroup_id is None:
+                context_dict['msg'] += " You are number " +\
+                    f"{lg.join_waitlist(stu)} in its waitlist, you " +\
+                    "will join it as soon as a seat is free."
         except LabGroup.DoesNotExist:
             # If it doesn't exist, return an error message
             context_dict['msg'] = request.POST['labGroup'] + " does not exist."
             context_dict['isError'] = True
             # Don't return anything, just continue as if it was a regular GET
 
-    # Compute and render the groups if you reach the end of the function
-    context_dict['groups'] = LabGroupForm(stu)
+    # Compute and render the groups if you reach the end of the function.
+    # The page fragment with the groups is cached (see applygroup.html)
+    # for everyone with the same theory group and pair status, until the
+    # seats change, so the form is only built if the fragment is missing
+    joining = 2 if stu.pairState == Student.PAIR_VALIDATED else 1
+    context_dict['groups'] = SimpleLazyObject(
+        lambda: lab_group_form(stu, joining))
+    context_dict['fragment'] = {
+        'theoryGroup': stu.theoryGroup_id,
+        'joining': joining,
+        'version': f'{seats.version()}:{eligibility.version()}'
+    }
+    # The page polls the seat counts, from the version it was rendered with
+    context_dict['seats'] = {
+        'version': seats.version(),
+        'interval': getattr(settings, 'SEAT_POLL_INTERVAL', 5)
+    }
 
     return render(request, 'core/applygroup.html', context_dict)
 
 
+def rank_groups(request, stu, context_dict):
+    """The Apply Group page during the preference window, where the student
+    ranks the groups he can join instead of joining one of them.
+    The groups are assigned in a batch when the window closes.
+
+    :param request: The user's HttpRequest object, which contains data about
+    the user
+    :type request: django.http.HttpRequest
+    :param stu: The student who ranks the groups
+    :type stu: core.models.Student
+    :param context_dict: The context of the Apply Group page
+    :type context_dict: dict
+    :return: The rendered Apply Group page, with the necessary info
+    :rtype: django.http.HttpResponse
+    """
+    if request.method == 'POST':
+        form = GroupPreferenceForm(stu, request.POST)
+        if form.is_valid():
+            form.save()
+            context_dict['msg'] = "Your preferences have been saved."
+            context_dict['isError'] = False
+        else:
+            context_dict['msg'] = " ".join(form.non_field_errors()) or\
+                "Please, select at least your first choice."
+            context_dict['isError'] = True
+    else:
+        form = GroupPreferenceForm(stu)
+    context_dict['preferences'] = form
+    context_dict['ranked'] = GroupPreference.objects.filter(student=stu)\
+        .select_related('labGroup')
+    return render(request, 'core/applygroup.html', context_dict)
+
+
+def seatcounts(request):
+    """
+    The live seat counts of the Apply Group page.
+    ===============================================
+    The free seats of the groups the student can join, as JSON, polled by
+    the page every ``SEAT_POLL_INTERVAL`` seconds so the students don't
+    need to reload it to see them.
+
+    It answers right away, without holding the worker: if the seat version
+    is still the one the page sent in ``?since=``, with an empty 204
+    response, without any query (not even the session or the user, who
+    are only loaded to send the new counts). The version alone tells
+    nothing about anybody.
+
+    :param request: The user's HttpRequest object, which contains data about
+    the user
+    :type request: django.http.HttpRequest
+    :return: The ``{version, groups}`` JSON response, or a 204 one
+    :rtype: django.http.HttpResponse
+    """
+    current = seats.version()
+    if request.GET.get('since') == str(current):
+        return HttpResponse(status=204)
+    return seatcounts_changed(request, current)
+
+
+@login_required
+def seatcounts_changed(request, current):
+    """The seat counts of :meth:`seatcounts`, once they changed
+
+    :param request: The user's HttpRequest object
+    :type request: django.http.HttpRequest
+    :param current: The current seat version
+    :type current: int
+    :rtype: django.http.JsonResponse
+    """
+    stu = Student.from_user(request.user)
+    joining = 2 if stu.pairState == Student.PAIR_VALIDATED else 1
+    group_ids = eligibility.lab_groups(stu.theoryGroup_id)
+    groups_with_space, snapshot = seats.with_space(group_ids, joining)
+    data = [{'id': g, 'name': snapshot[g]['name'],
+             'free': snapshot[g]['free'],
+             'open': g in groups_with_space}
+            for g in sorted((g for g in group_ids if g in snapshot),
+                            key=lambda g: snapshot[g]['name'])]
+    response = JsonResponse({'version': current, 'groups': data})
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
 @login_required
 def breakpair(request):
     """
@@ -482,7 +640,8 @@ def group(request, group_name_slug):
 @user_passes_test(lambda u: u.is_superuser)
 def groupchange(request):
     """The group change view, which displays a list of all the students
-    and lets the superuser change their groups
+    and lets the superuser change their groups. The list is paginated by
+    `GROUPCHANGE_PAGE_SIZE` students, or streamed whole with ``?all=1``
     Author: Miguel Herrera Martinez
 
     :param request: The user's HttpRequest object, which contains data about
@@ -524,14 +683,145 @@ def groupchange(request):
             context_dict['msg'] = request.POST['student'] + " does not exist."
             context_dict['isError'] = True
 
-    student_from_dict = []
-    for student in Student.objects.exclude(is_superuser=True):
-        lgForm = None
-        if student in LAB_GROUP_FORM_CACHE:
-            lgForm = LAB_GROUP_FORM_CACHE[student]
-        else:
-            lgForm = LabGroupForm(student)
-        student_from_dict.append([student, lgForm])
-    context_dict['students'] = student_from_dict
+    # Only the students that match the filters, if any
+    search = StudentSearchForm(request.GET)
+    students = search.filter(Student.objects.exclude(is_superuser=True))
+    context_dict['search'] = search
+    # The filters are kept in the links to the other pages, and the page
+    # too after changing the group of a student
+    query = request.GET.copy()
+    query.pop('after', None)
+    context_dict['query'] = query.urlencode()
+    context_dict['page_query'] = request.GET.urlencode()
+    # The select of each row is only rendered once for all the rows with
+    # the same choices, unless the whole markup is requested
+    expanded = bool(request.GET.get('expanded'))
+    if request.GET.get('all'):
+        return groupchange_stream(request, students, context_dict, expanded)
+
+    # Keyset pagination: the page starts after the (last name, first name,
+    # id) of the last student of the previous one, so any page costs the
+    # same, however far in the course
+    size = getattr(settings, 'GROUPCHANGE_PAGE_SIZE', 100)
+    try:
+        after = Student.objects.values_list('last_name', 'first_name', 'id')\
+            .get(id=int(request.GET['after']))
+    except (KeyError, ValueError, Student.DoesNotExist):
+        after = None
+    if after is not None:
+        last_name, first_name, sid = after
+        students = students.filter(last_name__gte=last_name).filter(
+            Q(last_name__gt=last_name) | Q(first_name__gt=first_name) |
+            Q(first_name=first_name, id__gt=sid))
+    rows = [GroupChangeRow(*row) for row in
+            groupchange_rows(students)[:size + 1]]
+    if len(rows) > size:
+        rows = rows[:size]
+        context_dict['next'] = rows[-1].id
+    context_dict['paginated'] = after is not None or 'next' in context_dict
+    context_dict['students'] = []
+    context_dict['choice_sets'] = []
+    for row, form, choices, new in groupchange_forms(rows, expanded):
+        context_dict['students'].append([row, form, choices])
+        if new:
+            context_dict['choice_sets'].append([choices, form])
 
     return render(request, 'core/groupchange.html', context_dict)
+
+
+# The fields of a student the group change page shows, instead of a full
+# model instance. It has a `theoryGroup_id`, so lab_group_form accepts it.
+GroupChangeRow = namedtuple('GroupChangeRow', [
+    'id', 'first_name', 'last_name', 'theoryGroup_id', 'theoryGroup',
+    'labGroup', 'partnered'])
+
+# Where the rows go in the rendered page, when they are streamed
+GROUPCHANGE_ROWS_MARKER = '<!-- groupchange rows -->'
+
+
+def groupchange_rows(students):
+    """Projects the students of the group change page, sorted by name (and
+    id, so the order is total for the pagination), with the names of their
+    groups and if they have a validated pair, all in the same query
+
+    :param students: The students to show
+    :type students: django.db.models.QuerySet
+    :return: A lazy queryset of `GroupChangeRow`
+    :rtype: django.db.models.QuerySet
+    """
+    partnered = Case(When(pairState=Student.PAIR_VALIDATED,
+                          then=Value(True)),
+                     default=Value(False), output_field=BooleanField())
+    return students.order_by('last_name', 'first_name', 'id')\
+        .annotate(partnered=partnered)\
+        .values_list('id', 'first_name', 'last_name', 'theoryGroup',
+                     'theoryGroup__groupName', 'labGroup__groupName',
+                     'partnered')
+
+
+def groupchange_forms(rows, expanded=False):
+    """Pairs each student of the group change page with his LabGroupForm,
+    and with the id of its choices, which is the same for every student
+    with the same theory group and pair status
+
+    :param rows: The students
+    :type rows: iterable
+    :param expanded: If the select is rendered in every row, instead of
+    once for each id of the choices
+    :type expanded: bool
+    :return: Generates (row, form, choices id or `None` if expanded, if it's
+    the first time that choices id is seen)
+    :rtype: generator
+    """
+    seen = set()
+    for row in rows:
+        joining = 2 if row.partnered else 1
+        choices = None if expanded else f'{row.theoryGroup_id}-{joining}'
+        new = choices is not None and choices not in seen
+        seen.add(choices)
+        yield row, lab_group_form(row, joining), choices, new
+
+
+def groupchange_stream(request, students, context_dict, expanded=False):
+    """Streams the whole group change page, rendering the students as
+    they are read from the database, so neither the memory used nor the
+    time to the first byte depend on the size of the course
+
+    :param request: The user's HttpRequest object
+    :type request: django.http.HttpRequest
+    :param students: The students to show
+    :type students: django.db.models.QuerySet
+    :param context_dict: The context of the page (messages)
+    :type context_dict: dict
+    :param expanded: If the select is rendered in every row
+    :type expanded: bool
+    :return: The streamed page
+    :rtype: django.http.StreamingHttpResponse
+    """
+    context_dict['streaming'] = True
+    head, tail = render_to_string('core/groupchange.html', context_dict,
+                                  request)\
+        .split(GROUPCHANGE_ROWS_MARKER)
+    row_template = get_template('core/groupchange_row.html')
+    choices_template = get_template('core/groupchange_choices.html')
+    # The rows are rendered without the request, so the context
+    # processors don't run for every one of them
+    csrf_token = get_token(request)
+
+    def content():
+        yield head
+        rows = (GroupChangeRow(*row)
+                for row in groupchange_rows(students).iterator())
+        for row, form, choices, new in groupchange_forms(rows, expanded):
+            # The choices go right before the first row that uses them
+            if new:
+                yield choices_template.render({'choices': choices,
+                                               'labGroupForm': form})
+            yield row_template.render({'student': row,
+                                       'labGroupForm': form,
+                                       'choices': choices,
+                                       'page_query':
+                                           context_dict['page_query'],
+                                       'csrf_token': csrf_token})
+        yield tail
+    return StreamingHttpResponse(content())
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.2/ref/settings/
 """
 
 import os
+import tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -117,6 +118,9 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# request.user is the Student, loaded with his groups in a single query
+AUTHENTICATION_BACKENDS = ['core.backends.StudentBackend']
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/2.2/topics/i18n/
@@ -141,3 +145,46 @@ STATICFILES_DIRS = [STATIC_DIR, ]
 
 # Login URL to redirect the users if they're not logged in
 LOGIN_URL = 'login'
+
+# Caches
+# The default cache is shared by all the workers of a host (it stores
+# the seat availability snapshot, among others). Point it to memcached
+# if the workers are spread across several hosts.
+# Once it has MAX_ENTRIES files, every write deletes a random third of
+# them (the default is only 300), so it must fit everything at once: about
+# two entries per student (his home fragment and pairs version), plus one
+# per lab group and a few per theory group (the seats, the versions and
+# the Apply Group fragments). 50000 is enough for 20000 students.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv('CACHE_DIR',
+                              os.path.join(tempfile.gettempdir(),
+                                           'labassign-cache')),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('CACHE_MAX_ENTRIES', 50000)),
+        },
+    }
+}
+# Seconds each worker keeps the OtherConstraints (saving them drops them
+# right away in the worker that saves them)
+OTHER_CONSTRAINTS_TTL = 60
+# Seconds between the checks of the shared version of the group constraints
+# index (changing them rebuilds it right away in the worker that changes them)
+ELIGIBILITY_CHECK_TTL = 5
+# Seconds the seat availability snapshot is kept, if nothing changes
+SEAT_CACHE_TIMEOUT = 60
+# Seconds between the checks of the live seat counts of the Apply Group page
+SEAT_POLL_INTERVAL = 5
+
+# Admission layer (waiting room) in front of the applygroup POST requests
+# Seat requests processed at the same time, on each host
+ADMISSION_SLOTS = int(os.getenv('ADMISSION_SLOTS', 20))
+# Seconds a waiting student waits before resending the request
+ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', 5))
+# Seconds without any waiting student retrying after which the tickets
+# left are considered abandoned, and the queue starts again from 1
+ADMISSION_IDLE_RESET = int(os.getenv('ADMISSION_IDLE_RESET', 60))
+
+# Students in each page of the group change page (?all=1 streams them all)
+GROUPCHANGE_PAGE_SIZE = 100
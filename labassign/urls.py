@@ -31,6 +31,7 @@ urlpatterns = [
     path('applypair/', views.applypair, name='applypair'),
     path('breakpair/', views.breakpair, name='breakpair'),
     path('applygroup/', views.applygroup, name='applygroup'),
+    path('applygroup/seats/', views.seatcounts, name='seatcounts'),
     path('admin/', admin.site.urls, name='admin'),
     path('groups/', views.groups, name='groups'),
     path('group/<slug:group_name_slug>', views.group, name='group'),